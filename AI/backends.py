@@ -0,0 +1,303 @@
+"""
+Inference backends behind `registry.LoadedModel`.
+
+Every backend takes a list of PIL images and returns, per image, the columns of its
+detections (see detections.py):
+    {"boxes": [[x1, y1, x2, y2], ...], "classes": [0, ...], "scores": [0.91234, ...], "names": {"0": "lantana"}}
+with box coordinates in original-image pixels, so callers cannot tell the backends apart.
+
+Settings (environment variables):
+    MODEL_TRACE_CACHE(bool, Default: 0): serve .pt models as a TorchScript trace, cached on disk next to the weights.
+    ONNX_THREADS(int, Default: 0): onnxruntime intra-op threads; 0 lets onnxruntime decide.
+"""
+import os
+
+class TorchBackend:
+    """
+    PyTorch weights (.pt) served through the Ultralytics YOLO object.
+    Layers are fused when the model is loaded. With trace=True (Default: os.environ["MODEL_TRACE_CACHE"])
+    a TorchScript trace of the fused model is served instead; it is cached next to the weights (see `traced`).
+    """
+    kind = "torch"
+
+    def __init__(self, path:str, trace:bool=None):
+        from ultralytics import YOLO
+        if trace is None:
+            trace = os.environ.get("MODEL_TRACE_CACHE", "0") not in ("0", "false", "False")
+        self.model = YOLO(path)
+        self.names = self.model.names
+        # Training image size, which Ultralytics also predicts at by default
+        imgsz = self.model.overrides.get("imgsz") or 640
+        self.imgsz = max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)
+        # Fold batch norms into the convolutions now rather than on the first request
+        self.model.fuse()
+        self.nbytes = self._nbytes(self.model)
+        self.trace = None
+        if trace:
+            self.trace = traced(path, self.model, self.imgsz)
+            self.model = YOLO(self.trace, task="detect")
+
+    @staticmethod
+    def _nbytes(model) -> int:
+        """
+        Size of the parameters and buffers, in bytes.
+        """
+        net = getattr(model, "model", None)
+        if net is None or not hasattr(net, "parameters"):
+            return 0
+        tensors = list(net.parameters()) + list(net.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def detect(self, images:list, conf:float=0.25, imgsz:int=None) -> list:
+        from detections import columns
+        from metrics import record, span
+
+        # A trace only takes the input size it was traced at
+        kwargs = {} if imgsz is None or self.trace else {"imgsz": imgsz}
+        results = self.model.predict(source=images, conf=conf, save=False, verbose=False, **kwargs)
+        # Ultralytics times its own stages, in milliseconds per image
+        speed = results[0].speed if results else {}
+        for stage, name in (("preprocess", "preprocess"), ("inference", "forward"), ("postprocess", "postprocess")):
+            if speed.get(stage) is not None:
+                record(name, speed[stage] * len(results) / 1000)
+        with span("postprocess"):
+            return [
+                columns(r.boxes.xyxy.cpu().numpy(), r.boxes.cls.cpu().numpy(), r.boxes.conf.cpu().numpy(), self.names)
+                for r in results
+            ]
+
+class YoloeBackend(TorchBackend):
+    """
+    A YOLOE open-vocabulary model prompted with a fixed set of class names (see vocabulary.py).
+    The text embeddings of the prompts come from the on-disk cache, so they are encoded once per model and prompt set.
+    """
+    kind = "yoloe"
+
+    def __init__(self, path:str, names:list=None):
+        from ultralytics import YOLOE
+        from vocabulary import prompts, textEmbeddings
+
+        self.model = YOLOE(path)
+        self.prompts = names or prompts()
+        self.model.set_classes(self.prompts, textEmbeddings(self.model, path, self.prompts))
+        self.names = self.model.names
+        imgsz = self.model.overrides.get("imgsz") or 640
+        self.imgsz = max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)
+        # Fused once the classes are set
+        self.model.fuse()
+        self.nbytes = self._nbytes(self.model)
+        self.trace = None
+
+class MmapBackend(TorchBackend):
+    """
+    Fused weights stored as safetensors (`run.py exportSafetensors`), memory-mapped read-only.
+    The network is built from the architecture saved with the weights and fused, then takes the mapped tensors
+    as its parameters without copying them (`load_state_dict(assign=True)`): every worker process serving the
+    file shares the same physical pages instead of holding its own copy of the weights.
+    """
+    kind = "mmap"
+
+    def __init__(self, path:str):
+        from ultralytics import YOLO
+
+        class Mapped(YOLO):
+            def _load(self, weights:str, task:str=None):
+                import json
+                from safetensors import safe_open
+                from safetensors.torch import load_file
+                from ultralytics.nn.tasks import DetectionModel
+
+                with safe_open(weights, framework="pt") as f:
+                    meta = f.metadata()
+                net = DetectionModel(json.loads(meta["yaml"]), verbose=False)
+                net.fuse(verbose=False)
+                # The random weights the network was built with are dropped here for the mapped ones
+                net.load_state_dict(load_file(weights), assign=True)
+                net.names = {int(c): name for c, name in json.loads(meta["names"]).items()}
+                net.args = json.loads(meta["args"])
+                net.task = net.args.get("task", "detect")
+                net.pt_path = weights
+                self.model = net.eval()
+                self.task = net.task
+                self.overrides = dict(net.args)
+                self.overrides["model"] = weights
+                self.ckpt_path = self.model_name = weights
+
+        self.model = Mapped(path)
+        self.names = self.model.names
+        imgsz = self.model.overrides.get("imgsz") or 640
+        self.imgsz = max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz)
+        self.nbytes = os.path.getsize(path)
+        self.trace = None
+
+    @staticmethod
+    def save(pt:str, path:str):
+        """
+        Write the fused weights of the .pt file `pt` to `path` as safetensors, with what `MmapBackend` needs to rebuild the network.
+        """
+        import json
+        from safetensors.torch import save_file
+        from ultralytics import YOLO
+
+        model = YOLO(pt)
+        model.fuse()
+        net = model.model
+        state = {name: tensor.detach().contiguous() for name, tensor in net.state_dict().items()}
+        save_file(state, path, metadata={
+            "yaml": json.dumps(net.yaml),
+            "names": json.dumps({str(c): name for c, name in net.names.items()}),
+            "args": json.dumps({k: v for k, v in model.overrides.items() if k != "model"}),
+        })
+
+class OnnxBackend:
+    """
+    An ONNX export of a YOLO detection model (`run.py export`) served through onnxruntime on CPU.
+    Pre- and post-processing (letterbox, NMS, rescaling) mirror what Ultralytics does for .pt models.
+    """
+    kind = "onnx"
+
+    def __init__(self, path:str, threads:int=None, iou:float=0.7, max_det:int=300):
+        import ast
+        import onnxruntime as ort
+
+        if threads is None:
+            threads = int(os.environ.get("ONNX_THREADS", 0))
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input = self.session.get_inputs()[0]
+        self.path = path
+        self.iou = iou
+        self.max_det = max_det
+
+        # Ultralytics stores class names and the export image size as metadata
+        meta = self.session.get_modelmeta().custom_metadata_map
+        names = meta.get("names")
+        self.names = ast.literal_eval(names) if names else {}
+        shape = self.input.shape # [batch, 3, h, w]; dimensions are strings when exported with dynamic=True
+        imgsz = ast.literal_eval(meta["imgsz"]) if "imgsz" in meta else [shape[2], shape[3]]
+        self.imgsz = imgsz[0] if isinstance(imgsz, (list, tuple)) else int(imgsz)
+        self.stride = int(meta.get("stride", 32))
+        self.fixed_batch = shape[0] if isinstance(shape[0], int) else None
+        self.dynamic = not isinstance(shape[2], int)
+
+    @property
+    def nbytes(self) -> int:
+        return os.path.getsize(self.path)
+
+    def detect(self, images:list, conf:float=0.25, imgsz:int=None) -> list:
+        import numpy as np
+        from imaging import letterboxBatch, scratch
+        from metrics import span
+
+        size = imgsz or self.imgsz
+        # Like Ultralytics, pad only up to the stride when the input size is free and all images share a shape
+        rect = self.dynamic and len({im.size for im in images}) == 1
+        n = len(images)
+        step = self.fixed_batch or n
+        with span("preprocess"):
+            frames, transforms = letterboxBatch(images, size, stride=self.stride if rect else None)
+            # A model exported with a fixed batch size has to be fed that many images at a time: pad the last chunk
+            total = -(-n // step) * step
+            batch = scratch("onnx", (total, 3, *frames.shape[1:3]), np.float32)
+            np.divide(frames.transpose(0, 3, 1, 2), np.float32(255), out=batch[:n], dtype=np.float32)
+            batch[n:] = 0
+
+        outputs = []
+        with span("forward"):
+            for i in range(0, n, step):
+                outputs.extend(self.session.run(None, {self.input.name: batch[i:i + step]})[0])
+
+        with span("postprocess"):
+            return [
+                self._detections(output, conf, gain, pad, im.size)
+                for output, (gain, pad), im in zip(outputs, transforms, images)
+            ]
+
+    def _detections(self, output, conf:float, gain:float, pad:tuple, size:tuple) -> dict:
+        """
+        Turn one raw YOLO output of shape (4 + classes, anchors) into detection columns in original-image pixels.
+        """
+        import numpy as np
+        from detections import columns
+
+        pred = output.T
+        scores = pred[:, 4:]
+        classes = scores.argmax(1)
+        confidences = scores[np.arange(len(pred)), classes]
+        keep = confidences > conf
+        pred, classes, confidences = pred[keep], classes[keep], confidences[keep]
+
+        # (x_center, y_center, w, h) -> (x1, y1, x2, y2)
+        boxes = np.empty((len(pred), 4), dtype=np.float32)
+        boxes[:, :2] = pred[:, :2] - pred[:, 2:4] / 2
+        boxes[:, 2:] = pred[:, :2] + pred[:, 2:4] / 2
+
+        keep = nms(boxes, confidences, classes, self.iou)[:self.max_det]
+        boxes, classes, confidences = boxes[keep], classes[keep], confidences[keep]
+
+        # Undo the letterbox
+        boxes[:, [0, 2]] = ((boxes[:, [0, 2]] - pad[0]) / gain).clip(0, size[0])
+        boxes[:, [1, 3]] = ((boxes[:, [1, 3]] - pad[1]) / gain).clip(0, size[1])
+
+        return columns(boxes, classes, confidences, self.names)
+
+def nms(boxes, scores, classes, iou:float=0.7, smaller:bool=False) -> list:
+    """
+    Class-aware non-maximum suppression.
+    smaller(bool, Default=False): measure overlap as intersection over the smaller box instead of IoU,
+    so that a box nested in a higher scoring one is suppressed (used to merge tiles, see tiling.py).
+    Returns the indices of the kept boxes, highest score first.
+    """
+    import numpy as np
+
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Offset boxes by class so that boxes of different classes never overlap
+    offset = boxes + (classes.astype(np.float32) * (boxes.max() + 1))[:, None]
+    x1, y1, x2, y2 = offset.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+    keep = []
+    while len(order):
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = (np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest])).clip(0)
+        h = (np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest])).clip(0)
+        inter = w * h
+        if smaller:
+            overlap = inter / (np.minimum(areas[i], areas[rest]) + 1e-9)
+        else:
+            overlap = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[overlap <= iou]
+    return np.array(keep, dtype=np.int64)
+
+def traced(path:str, model, imgsz:int) -> str:
+    """
+    Path of the TorchScript trace of the .pt weights `path` (a loaded YOLO `model`) at input size `imgsz`:
+    <weights>.torchscript, exported the first time and again whenever the weights are newer than it.
+    """
+    import fcntl
+
+    trace = os.path.splitext(path)[0] + ".torchscript"
+    with open(path, "rb") as weights:
+        # Process workers load the same weights at once: one exports, the others wait for it
+        fcntl.flock(weights, fcntl.LOCK_EX)
+        if not os.path.exists(trace) or os.path.getmtime(trace) < os.path.getmtime(path):
+            print(f" [ Tracing {path} to {trace} ... ]")
+            model.export(format="torchscript", imgsz=imgsz, verbose=False)
+    return trace
+
+def load(path:str):
+    """
+    Create the backend for a model file, chosen by its extension; YOLOE weights (yoloe*.pt) are served open-vocabulary.
+    """
+    if path.endswith(".onnx"):
+        return OnnxBackend(path)
+    if path.endswith(".safetensors"):
+        return MmapBackend(path)
+    if os.path.basename(path).lower().startswith("yoloe"):
+        return YoloeBackend(path)
+    return TorchBackend(path)
@@ -0,0 +1,330 @@
+"""
+Dynamic micro-batching for the detection endpoint.
+
+Concurrent requests for the same model (and confidence threshold) are collected for
+a short window and run as one batched `predict` call; each request then gets back its
+own slice of the results. A single request waits at most `wait_ms` longer than before.
+Batches run on the bounded inference pool (see workers.py), never on the event loop,
+and as many batches run at once as the pool has workers.
+Uploads seen before are answered from the prediction cache (see cache.py) without queueing,
+and an upload identical to one still running (a retry, a double tap) waits for that one's
+result instead of running again. Images whose request deadline has passed are dropped before
+they run (see deadlines.py).
+
+Settings (environment variables):
+    BATCH_MAX_SIZE(int, Default: 8): most images run in one batch.
+    BATCH_WAIT_MS(float, Default: 10): how long the first request of a batch waits for others to join.
+    BATCH_QUEUE_SIZE(int, Default: 64): most images waiting for a batch, or for the pipeline's decode stage on their way
+        to one; beyond it requests are rejected with `QueueFull`.
+"""
+import os
+import math
+import time
+import asyncio
+
+from cache import PredictionCache, cache
+from deadlines import DeadlineExceeded, dropped, expired, latest
+from pipeline import pipeline
+from quality import RetakePhoto, gate
+from metrics import Timings
+from registry import ModelRegistry
+from workers import Busy, pool
+
+class QueueFull(Busy):
+    """
+    Raised by `MicroBatcher.submit` when too many images are already waiting.
+    """
+
+class MicroBatcher:
+    """
+    Collects images submitted from request handlers into batches, one queue per (model, conf).
+    run_batch(model, images, conf) must return one result per image; it is blocking and runs on `pool`. An exception
+    returned in place of a result fails that image only. Default: `run.predictColumns`, whose results are detection
+    columns (see detections.py), with undecodable images isolated.
+    With a `pipeline.Pipeline`, uploads are decoded on its decode stage before they join a batch.
+    With a `quality.QualityGate`, uploads are screened before anything else and rejected with `quality.RetakePhoto`.
+    """
+    def __init__(self, run_batch=None, max_batch:int=None, wait_ms:float=None, max_queue:int=None, cache=None, pipeline=None, gate=None):
+        if run_batch is None:
+            from functools import partial
+            from run import predictColumns
+            run_batch = partial(predictColumns, isolate=True)
+        self.run_batch = run_batch
+        self.cache = cache
+        self.pipeline = pipeline
+        self.gate = gate
+        self.max_batch = max_batch or int(os.environ.get("BATCH_MAX_SIZE", 8))
+        self.wait = (wait_ms if wait_ms is not None else float(os.environ.get("BATCH_WAIT_MS", 10))) / 1000
+        self.max_queue = max_queue or int(os.environ.get("BATCH_QUEUE_SIZE", 64))
+        self._queues = {} # (model, conf) -> [(image, future, submitted at, timings, deadline getter)]
+        self._wakeups = {} # (model, conf) -> asyncio.Event, set when an image joins the queue
+        self._drainers = {} # (model, conf) -> asyncio.Task collecting and running batches
+        self._slots = asyncio.Semaphore(pool.workers) # one batch in flight per worker
+        self._running = set() # batch tasks, referenced until they finish
+        self._inflight = {} # cache key -> [task running the image, requests waiting for it, latest of their deadlines]
+        # Metrics
+        self.batches = 0
+        self.images = 0
+        self.rejected = 0
+        self.deduplicated = 0
+        self.last_batch_size = 0
+        self.max_batch_seen = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def depth(self) -> int:
+        """
+        Images currently waiting for a batch.
+        """
+        return sum(len(q) for q in self._queues.values())
+
+    @property
+    def backlog(self) -> int:
+        """
+        Images waiting for a batch, or for (or in) the pipeline's decode stage on their way to one.
+        """
+        decoding = self.pipeline.decoding if self.pipeline is not None and self.pipeline.enabled else 0
+        return self.depth + decoding
+
+    async def submit(self, model:str, image, conf:float=0.25, tile:bool=False, timings=None, screen:bool=True, deadline:float=None, cache:bool=True):
+        """
+        Queue one image for `model` and wait for its result.
+        Encoded images (bytes) are looked up in, and then added to, `cache`. While an identical image
+        (same bytes, model, conf and tile) is running, it is not run again: its result is shared.
+        tile(bool, Default=False): run the image as overlapping tiles (see tiling.py). Its tiles already make
+        a batch, so it goes straight to the pool instead of joining other images.
+        timings(metrics.Timings, Default=None): gets the time spent queueing and the stages of the batch.
+        screen(bool, Default=True): run encoded images through `gate` first; raises `quality.RetakePhoto` if they fail.
+        deadline(float, Default=None): Unix time after which nobody waits for the result; raises `deadlines.DeadlineExceeded`
+        if it passes before the image runs. An image shared by identical requests runs until the latest of their deadlines.
+        cache(bool, Default=True): look the image up in `cache` and among the running ones. Off for images that are never
+        sent twice, e.g. live camera frames, which would only push real uploads out of the cache.
+        """
+        if expired(deadline):
+            dropped.record("queue", "deadline")
+            raise DeadlineExceeded()
+        key = identity = None
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            if screen and self.gate is not None and self.gate.enabled:
+                await self.gate.screen(image)
+        if cache and isinstance(image, (bytes, bytearray, memoryview)):
+            identity = ModelRegistry.key(model)
+            key = PredictionCache.key(image, model, conf, variant="tiled" if tile else "", identity=identity)
+            if self.cache is not None and self.cache.enabled:
+                result = await self.cache.lookup(key)
+                if result is not None:
+                    return result
+        if key is None:
+            return await self._submit(model, image, conf, tile, timings, (key, identity), lambda: deadline)
+
+        # An identical request is already running: wait for its result instead of running the image again
+        flight = self._inflight.get(key)
+        follower = flight is not None
+        if follower:
+            self.deduplicated += 1
+            flight[2] = latest(flight[2], deadline)
+        else:
+            flight = self._inflight[key] = [None, 0, deadline]
+            task = flight[0] = asyncio.get_running_loop().create_task(self._submit(model, image, conf, tile, timings, (key, identity), lambda: flight[2]))
+
+            def landed(task:asyncio.Task):
+                del self._inflight[key]
+                if not task.cancelled():
+                    task.exception() # retrieved here, in case every request waiting for it went away
+            task.add_done_callback(landed)
+        task = flight[0]
+        flight[1] += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.shield(task)
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not task.done():
+                # Every request waiting for it went away: do not run it
+                task.cancel()
+            if follower and timings is not None:
+                timings.record("queue", time.perf_counter() - start)
+
+    async def _submit(self, model:str, image, conf:float, tile:bool, timings, key:tuple, deadline):
+        """
+        Run one image, as `submit` does once the cache and the in-flight requests have been looked up.
+        key: (cache key, registry key of the model it was made for), both None for images that are not cached.
+        deadline: returns the image's current deadline, which identical requests joining it may extend.
+        """
+        if tile:
+            from run import predictColumns
+            models = []
+            result = (await pool.run(predictColumns, model, [image], conf, True, spans=[timings] if timings else None, models=models))[0]
+            self._store(key, models, result)
+            return result
+
+        if self.backlog >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull(f"{self.backlog} images are already waiting.", self.retryAfter())
+        if self.pipeline is not None and self.pipeline.enabled and isinstance(image, (bytes, bytearray, memoryview)):
+            # Decode on the pipeline's decode stage while earlier batches run (see pipeline.py)
+            image = await self.pipeline.decode(model, image, timings)
+
+        loop = asyncio.get_running_loop()
+        queue_key = (model, conf)
+        future = loop.create_future()
+        self._queues.setdefault(queue_key, []).append((image, future, time.perf_counter(), timings, deadline))
+        self._wakeups.setdefault(queue_key, asyncio.Event()).set()
+        if queue_key not in self._drainers:
+            self._drainers[queue_key] = loop.create_task(self._drain(queue_key))
+        result, models = await future
+        self._store(key, models, result)
+        return result
+
+    def _store(self, key:tuple, models:list, result):
+        """
+        Add `result` to the cache, unless it came from another model than the one its cache key was made for:
+        while new weights for a name load, the old model still answers for it (see registry.ModelRegistry.get).
+        """
+        key, identity = key
+        if key is not None and self.cache is not None and self.cache.enabled and set(models) == {identity}:
+            self.cache.put(key, result)
+
+    async def stream(self, model:str, images:list, conf:float=0.25, window:int=None):
+        """
+        Run many images for one client and yield one line per image as soon as it finishes.
+        images: [(filename, image)], where image is anything `submit` accepts.
+        Yields dicts with "index", "file" and either "detections" (as returned by `submit`) or "error", in completion order.
+        At most `window` images (Default: 2 batches) are queued at once, so one large upload cannot fill the whole queue.
+        """
+        semaphore = asyncio.Semaphore(window or 2 * self.max_batch)
+
+        async def one(index:int, filename:str, image):
+            line = {"index": index, "file": filename}
+            timings = Timings()
+            async with semaphore:
+                try:
+                    line["detections"] = await self.submit(model, image, conf, timings=timings)
+                except Busy:
+                    line["error"] = "Server is busy, please try again later."
+                except RetakePhoto as e:
+                    line.update(e.response())
+                except Exception as e:
+                    line["error"] = str(e)
+                else:
+                    timings.finish("batch")
+            return line
+
+        tasks = [asyncio.ensure_future(one(i, filename, image)) for i, (filename, image) in enumerate(images)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # The client went away: do not run what is still queued
+            for task in tasks:
+                task.cancel()
+
+    async def _drain(self, key:tuple):
+        """
+        Run batches for `key` until its queue is empty.
+        """
+        queue = self._queues[key]
+        wakeup = self._wakeups[key]
+        loop = asyncio.get_running_loop()
+        try:
+            while queue:
+                # Wait for a free worker; images keep queueing meanwhile, so batches grow under load
+                await self._slots.acquire()
+                # Give other requests up to `wait` seconds to join, unless the batch is already full
+                deadline = loop.time() + self.wait
+                while len(queue) < self.max_batch:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    wakeup.clear()
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+
+                batch = [item for item in queue[:self.max_batch] if not item[1].done() and not self._expire(item)]
+                del queue[:self.max_batch]
+                if not batch:
+                    self._slots.release()
+                    continue
+                task = loop.create_task(self._run(key, batch))
+                self._running.add(task)
+                task.add_done_callback(self._finished)
+        finally:
+            del self._drainers[key]
+
+    def _expire(self, item:tuple) -> bool:
+        """
+        Fail a queued image with `DeadlineExceeded` if its deadline has passed; returns whether it did.
+        """
+        _, future, _, _, deadline = item
+        if not expired(deadline()):
+            return False
+        future.set_exception(DeadlineExceeded())
+        dropped.record("queue", "deadline")
+        return True
+
+    def _finished(self, task:asyncio.Task):
+        self._running.discard(task)
+        self._slots.release()
+
+    async def _run(self, key:tuple, batch:list):
+        model, conf = key
+        now = time.perf_counter()
+        for _, _, submitted, timings, _ in batch:
+            self.wait_total += now - submitted
+            self.wait_max = max(self.wait_max, now - submitted)
+            if timings is not None:
+                timings.record("queue", now - submitted)
+        self.batches += 1
+        self.images += len(batch)
+        self.last_batch_size = len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+
+        models = [] # the model that ran the batch
+        try:
+            spans = [timings for _, _, _, timings, _ in batch if timings is not None]
+            results = await pool.run(self.run_batch, model, [image for image, _, _, _, _ in batch], conf, spans=spans, models=models)
+        except Exception as e:
+            for _, future, _, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future, _, _, _), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                # Only this image is broken, e.g. a truncated upload; the rest of the batch has its results
+                future.set_exception(result)
+            else:
+                future.set_result((result, models))
+
+    def retryAfter(self) -> int:
+        """
+        Estimated seconds until the queued images have been run.
+        """
+        batches = math.ceil(self.backlog / self.max_batch) + pool.waiting + 1
+        mean_run = pool.run_total / pool.jobs if pool.jobs else 1.0
+        return max(1, math.ceil(mean_run * batches / pool.workers))
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_batch,
+            "wait_ms": self.wait * 1000,
+            "max_queue": self.max_queue,
+            "queue_depth": self.depth,
+            "batches": self.batches,
+            "images": self.images,
+            "rejected": self.rejected,
+            "deduplicated": self.deduplicated,
+            "in_flight": len(self._inflight),
+            "mean_batch_size": round(self.images / self.batches, 2) if self.batches else 0.0,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size_seen": self.max_batch_seen,
+            "mean_wait_ms": round(self.wait_total / self.images * 1000, 2) if self.images else 0.0,
+            "max_wait_ms": round(self.wait_max * 1000, 2),
+        }
+
+# The batcher shared by the request handlers in this process
+batcher = MicroBatcher(cache=cache, pipeline=pipeline, gate=gate)
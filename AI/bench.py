@@ -0,0 +1,392 @@
+"""
+Serving benchmarks for the inference servers.
+Usage: python bench.py <command> [--options], e.g. `python bench.py upload --model=latest.pt --images=raw`
+"""
+import os
+import time
+
+from imaging import IMAGE_EXTS
+
+## internal functions
+def __touch(model:str) -> int:
+    """
+    Run one image through `model` on a worker, so that its weights are paged in; returns the worker's pid.
+    """
+    from PIL import Image
+    from run import predictColumns
+
+    predictColumns(model, [Image.new("RGB", (640, 480))])
+    return os.getpid()
+
+def __images(images:str, limit:int=None) -> list:
+    """
+    Image files under `images` (a folder or a single file), sorted by name.
+    """
+    if os.path.isfile(images):
+        return [images]
+    files = sorted(
+        os.path.join(a, name)
+        for a, b, c in os.walk(images)
+        for name in c if name.lower().endswith(IMAGE_EXTS)
+    )
+    return files[:limit] if limit else files
+
+def __percentile(values:list, q:float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def __summary(latencies:list) -> dict:
+    """
+    Latency summary in milliseconds.
+    """
+    ms = [x * 1000 for x in latencies]
+    return {
+        "n": len(ms),
+        "mean_ms": round(sum(ms) / len(ms), 2) if ms else 0.0,
+        "p50_ms": round(__percentile(ms, 50), 2),
+        "p95_ms": round(__percentile(ms, 95), 2),
+        "p99_ms": round(__percentile(ms, 99), 2),
+    }
+
+def __decodeRun(uploads:list, imgsz:int, draft:bool, repeat:int) -> dict:
+    """
+    Decode and letterbox every upload `repeat` times in this (fresh) process; returns latency and peak RSS.
+    """
+    import resource
+    import imaging
+
+    imaging.DRAFT = draft
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies = []
+    for _ in range(repeat):
+        for data in uploads:
+            start = time.perf_counter()
+            im = imaging.openImage(data, imgsz)
+            imaging.letterboxBatch([im], imgsz)
+            latencies.append(time.perf_counter() - start)
+            del im
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KiB on Linux
+    return {**__summary(latencies), "peak_rss_mb": round(peak / 1024, 1), "decode_rss_mb": round((peak - before) / 1024, 1)}
+
+## exported functions
+def upload(model:str="latest.pt", images:str="raw", limit:int=50, repeat:int=3, folder:str="uploads_bench"):
+    """
+    Per-request latency of the upload handling in `/predict`: the old path
+    (write the upload to disk, reopen it, delete it) against decoding the upload bytes in memory.
+    The model is loaded before timing, so only the forward pass and upload handling are measured.
+    """
+    from imaging import saveUpload
+    from registry import registry
+    from run import predict
+
+    files = __images(images, limit)
+    if not files:
+        print(f"No images found in {images}.")
+        return
+    uploads = []
+    for name in files:
+        with open(name, 'rb') as f:
+            uploads.append((os.path.basename(name), f.read()))
+    registry.preload(model)
+
+    def disk(filename, data):
+        path = saveUpload(data, filename, folder)
+        predict(model=model, img=path, visualize=False)
+        os.remove(path)
+
+    def memory(filename, data):
+        predict(model=model, img=data, visualize=False)
+
+    report = {}
+    for mode, handle in (("disk", disk), ("memory", memory)):
+        latencies = []
+        for _ in range(repeat):
+            for filename, data in uploads:
+                start = time.perf_counter()
+                handle(filename, data)
+                latencies.append(time.perf_counter() - start)
+        report[mode] = __summary(latencies)
+        print(f"{mode:>8}: {report[mode]}")
+
+def workers(model:str="latest.pt", images:str="raw", limit:int=32, splits:str=None, requests:int=64, concurrency:int=16, batch:int=1):
+    """
+    Sweep the split of the CPU between inference processes and torch threads per process.
+    splits(str): comma separated "<workers>x<threads>", e.g. "1x8,2x4,4x2,8x1". Default: every split of the physical cores.
+    Each split serves `requests` jobs of `batch` images with `concurrency` jobs in flight, and reports images/sec and latency.
+    """
+    import asyncio
+    from run import predictColumns
+    from workers import InferencePool, physicalCores
+
+    files = __images(images, limit)
+    if not files:
+        print(f"No images found in {images}.")
+        return
+    uploads = []
+    for name in files:
+        with open(name, 'rb') as f:
+            uploads.append(f.read())
+    if splits is None:
+        cores = physicalCores()
+        splits = ",".join(f"{w}x{cores // w}" for w in range(1, cores + 1) if cores % w == 0)
+    os.environ["DEFAULT_MODEL"] = model # preloaded by every worker process
+
+    async def serve(pool):
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def one(i):
+            job = [uploads[(i * batch + j) % len(uploads)] for j in range(batch)]
+            async with semaphore:
+                start = time.perf_counter()
+                await pool.run(predictColumns, model, job)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(requests)])
+        return latencies, time.perf_counter() - start
+
+    for split in str(splits).split(","):
+        n_workers, n_threads = map(int, split.split("x"))
+        pool = InferencePool(kind="process", workers=n_workers, threads=n_threads, queue_size=requests)
+        pool.ready()
+        latencies, elapsed = asyncio.run(serve(pool))
+        pool.shutdown()
+        report = {"workers": n_workers, "threads": n_threads, "images_per_sec": round(requests * batch / elapsed, 2), **__summary(latencies)}
+        print(report)
+
+def decode(images:str="raw", limit:int=50, imgsz:int=640, repeat:int=3):
+    """
+    Decode + letterbox time and peak memory of full-resolution decoding against reduced-resolution JPEG decoding (imaging.DECODE_DRAFT).
+    Each mode runs in a fresh process so that its peak RSS is not hidden by the other one.
+    """
+    import multiprocessing
+
+    files = __images(images, limit)
+    if not files:
+        print(f"No images found in {images}.")
+        return
+    uploads = []
+    for name in files:
+        with open(name, 'rb') as f:
+            uploads.append(f.read())
+
+    context = multiprocessing.get_context("spawn")
+    for mode, draft in (("full", False), ("draft", True)):
+        with context.Pool(1) as worker:
+            report = worker.apply(__decodeRun, (uploads, imgsz, draft, repeat))
+        print({"mode": mode, "images": len(uploads), **report})
+
+def tiles(model:str="latest.pt", images:str="raw", limit:int=20, repeat:int=3):
+    """
+    Cost of tiled inference (tiling.py) against plain inference, per image and per megapixel.
+    Images are decoded once up front so that only detection is timed.
+    """
+    from PIL import Image
+    from registry import registry
+    from tiling import detectTiled, grid
+
+    files = __images(images, limit)
+    if not files:
+        print(f"No images found in {images}.")
+        return
+    loaded = registry.get(model)
+    ims = []
+    for name in files:
+        with Image.open(name) as im:
+            ims.append(im.convert("RGB"))
+    megapixels = sum(im.size[0] * im.size[1] for im in ims) / 1e6
+
+    modes = {
+        "plain": lambda im: loaded.detect([im]),
+        "tiled": lambda im: detectTiled(loaded, im),
+    }
+    for mode, fn in modes.items():
+        fn(ims[0])
+        latencies = []
+        for _ in range(repeat):
+            for im in ims:
+                start = time.perf_counter()
+                fn(im)
+                latencies.append(time.perf_counter() - start)
+        report = {
+            "mode": mode,
+            "images": len(ims),
+            "megapixels": round(megapixels / len(ims), 2),
+            "ms_per_megapixel": round(sum(latencies) * 1000 / (megapixels * repeat), 2),
+            **__summary(latencies),
+        }
+        if mode == "tiled":
+            size = int(os.environ.get("TILE_SIZE", 0)) or loaded.imgsz
+            overlap = float(os.environ.get("TILE_OVERLAP", 0.2))
+            report["tiles_per_image"] = round(sum(len(grid(*im.size, size, overlap)) for im in ims) / len(ims), 1)
+        print(report)
+
+def oversized(server:str="server", port:int=8011, size_mb:int=100, concurrency:int=16, rounds:int=3, chunk_kb:int=256):
+    """
+    RSS of an inference server under concurrent oversized uploads (see uploads.py).
+    Starts `server` (a module with an `app`) on `port` in a separate process, then `rounds` times sends `concurrency`
+    uploads of `size_mb` MB each to /predict at once, streamed from a generator so the client holds no copy.
+    Reports the server's RSS before, after every round and at its peak; with the upload limit it stays flat.
+    A rejected upload shows as 413, or as a ReadError when the server answered and closed while the client was still sending.
+    """
+    import asyncio
+    import subprocess
+    import sys
+    import threading
+    import httpx
+    import psutil
+
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", f"{server}:app", "--port", str(port), "--log-level", "warning"])
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(600):
+            try:
+                httpx.get(url + "/metrics", timeout=1)
+                break
+            except httpx.HTTPError:
+                time.sleep(0.5)
+        memory = psutil.Process(process.pid)
+        peak = [memory.memory_info().rss]
+        sampling = threading.Event()
+
+        def sample():
+            while not sampling.wait(0.05):
+                peak[0] = max(peak[0], memory.memory_info().rss)
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+
+        async def upload(client):
+            chunk = b"\xff" * (chunk_kb * 1024)
+            boundary = "benchboundary"
+
+            async def body():
+                yield f'--{boundary}\r\nContent-Disposition: form-data; name="img"; filename="big.jpg"\r\nContent-Type: image/jpeg\r\n\r\n'.encode()
+                for _ in range(size_mb * 1024 // chunk_kb):
+                    yield chunk
+                yield f"\r\n--{boundary}--\r\n".encode()
+
+            start = time.perf_counter()
+            try:
+                # No Content-Length: the server has to count the body as it arrives
+                response = await client.post(url + "/predict", content=body(), headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            return status, time.perf_counter() - start
+
+        async def burst():
+            async with httpx.AsyncClient(timeout=120) as client:
+                return await asyncio.gather(*[upload(client) for _ in range(concurrency)])
+
+        mb = lambda n: round(n / 2**20, 1)
+        print({"round": 0, "rss_mb": mb(memory.memory_info().rss)})
+        for i in range(rounds):
+            results = asyncio.run(burst())
+            statuses = sorted({str(status) for status, _ in results})
+            print({"round": i + 1, "statuses": statuses, **__summary([took for _, took in results]), "rss_mb": mb(memory.memory_info().rss)})
+        sampling.set()
+        sampler.join()
+        print({"peak_rss_mb": mb(peak[0]), "uploaded_mb": size_mb * concurrency * rounds})
+    finally:
+        process.terminate()
+        process.wait()
+
+def pipeline(model:str="latest.pt", images:str="raw", limit:int=32, requests:int=128, concurrency:int=16, repeat:int=2):
+    """
+    Throughput of the staged pipeline (pipeline.py) against the sequential path, through the batcher and a thread pool.
+    Sequential: each batch is decoded on the inference worker and each response encoded inline, as without the pipeline.
+    Every request carries distinct bytes, so neither the cache nor in-flight de-duplication answers any of them.
+    """
+    import asyncio
+    from batching import MicroBatcher
+    from detections import JSON, render
+    from pipeline import Pipeline
+    from registry import registry
+
+    files = __images(images, limit)
+    if not files:
+        print(f"No images found in {images}.")
+        return
+    uploads = []
+    for name in files:
+        with open(name, 'rb') as f:
+            uploads.append(f.read())
+    registry.preload(model)
+
+    async def serve(staged:bool, run:int):
+        stages = Pipeline(enabled=staged)
+        batcher = MicroBatcher(max_queue=requests, pipeline=stages)
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def one(i):
+            # Bytes after the end of the image are ignored by decoders but make every upload distinct
+            data = uploads[i % len(uploads)] + f"{run}:{i}".encode()
+            async with semaphore:
+                start = time.perf_counter()
+                detections = await batcher.submit(model, data)
+                if staged:
+                    await stages.serialize(detections, JSON)
+                else:
+                    render(detections, JSON)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(requests)])
+        elapsed = time.perf_counter() - start
+        stages.shutdown()
+        return latencies, elapsed, batcher.stats()["mean_batch_size"]
+
+    for run in range(repeat + 1):
+        for mode, staged in (("sequential", False), ("pipelined", True)):
+            latencies, elapsed, batch = asyncio.run(serve(staged, run))
+            if run == 0:
+                continue # warm-up
+            print({"mode": mode, "run": run, "images_per_sec": round(requests / elapsed, 2), "mean_batch_size": batch, **__summary(latencies)})
+
+def sharing(model:str="latest.pt", formats:str="pt,mmap", workers:int=4):
+    """
+    Memory of process workers serving `model` as .pt weights (a private copy each) against memory-mapped safetensors
+    (shared pages, see `run.py exportSafetensors`). For each format, pools of 1 and `workers` processes load the model and
+    run one image; reports RSS, USS (private) and PSS (proportional share) per worker, and the memory each additional
+    worker costs: the growth of the workers' total PSS from 1 to `workers` processes, per added process.
+    """
+    import psutil
+    from registry import resolveModel
+    from workers import InferencePool
+
+    def measure(path:str, n:int) -> list:
+        os.environ["DEFAULT_MODEL"] = path # preloaded by every worker process
+        pool = InferencePool(kind="process", workers=n, threads=1, queue_size=n)
+        try:
+            pids = pool.broadcast(__touch, path)
+            return [psutil.Process(pid).memory_full_info() for pid in pids]
+        finally:
+            pool.shutdown()
+
+    mb = lambda n: round(n / 2**20, 1)
+    for variant in formats.split(","):
+        path = resolveModel(model if variant == "pt" else f"{model}:{variant}")
+        if path is None:
+            print(f"{model} has no {variant} variant; run `python run.py exportSafetensors --model={model}` first.")
+            continue
+        one = measure(path, 1)
+        many = measure(path, workers)
+        total_one, total_many = sum(m.pss for m in one), sum(m.pss for m in many)
+        print({
+            "format": variant,
+            "model": path,
+            "workers": workers,
+            "rss_mb": mb(sum(m.rss for m in many) / workers),
+            "uss_mb": mb(sum(m.uss for m in many) / workers),
+            "pss_mb": mb(total_many / workers),
+            "total_pss_mb": mb(total_many),
+            "per_additional_worker_mb": mb((total_many - total_one) / max(1, workers - 1)),
+        })
+
+if __name__ == "__main__":
+    import fire
+    fire.Fire()
@@ -0,0 +1,182 @@
+"""
+Content-addressed cache of predictions.
+
+Retries, double taps and the same photo shared from the scan history resubmit bytes we
+have already run. Results are keyed by the SHA-256 of the uploaded bytes together with
+the model identity (real path and mtime of the weights, so a retrained model never
+serves stale results) and the confidence threshold.
+
+Entries live in a bounded in-memory LRU with a TTL, optionally backed by a folder of
+JSON files that survives restarts. The folder is read and written on the cache's own I/O
+thread (writes behind the request), never on the event loop.
+
+Settings (environment variables):
+    PREDICTION_CACHE_SIZE(int, Default: 1024): most entries kept in memory; 0 disables the cache.
+    PREDICTION_CACHE_TTL(float, Default: 3600): seconds an entry stays valid.
+    PREDICTION_CACHE_DIR(str, Default: None): folder for the on-disk store; memory only if not set.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Bumped whenever the format of cached values changes, so that old entries on disk are never read back
+FORMAT = 2 # 2: detection columns (see detections.py)
+
+class PredictionCache:
+    def __init__(self, max_entries:int=None, ttl:float=None, folder:str=None):
+        self.max_entries = max_entries if max_entries is not None else int(os.environ.get("PREDICTION_CACHE_SIZE", 1024))
+        self.ttl = ttl if ttl is not None else float(os.environ.get("PREDICTION_CACHE_TTL", 3600))
+        self.folder = folder if folder is not None else os.environ.get("PREDICTION_CACHE_DIR")
+        self._entries = OrderedDict() # key -> (expires at, value)
+        self._lock = threading.Lock()
+        self._executor = None # the I/O thread of the on-disk store, started on first use
+        # Metrics
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.folder:
+            os.makedirs(self.folder, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def key(data, model:str, conf:float, variant:str="", identity:tuple=None) -> str:
+        """
+        Cache key of an upload: hash of its bytes, the model identity, the confidence threshold
+        and the inference variant, e.g. "tiled".
+        identity(tuple, Default=None): registry key of the model (see registry.ModelRegistry.key); Default: the one `model` points to now.
+        """
+        from registry import ModelRegistry
+        path, mtime = identity or ModelRegistry.key(model)
+        digest = hashlib.sha256(data).hexdigest()
+        return hashlib.sha256(f"{digest}|{path}|{mtime}|{conf}|{variant}|{FORMAT}".encode()).hexdigest()
+
+    def get(self, key:str):
+        """
+        The cached value for `key`, or None. Reads the on-disk store in this thread: on the event loop, use `lookup`.
+        """
+        value = self._fromMemory(key)
+        return value if value is not None else self._fromDisk(key)
+
+    async def lookup(self, key:str):
+        """
+        `get`, reading the on-disk store on the cache's I/O thread.
+        """
+        value = self._fromMemory(key)
+        if value is not None:
+            return value
+        if not self.folder:
+            return self._fromDisk(key)
+        return await asyncio.get_running_loop().run_in_executor(self._io(), self._fromDisk, key)
+
+    def put(self, key:str, value):
+        """
+        Add `value` for `key`; it is written to the on-disk store behind the caller, on the cache's I/O thread.
+        """
+        entry = (time.time() + self.ttl, value)
+        with self._lock:
+            self._remember(key, entry)
+        if self.folder:
+            self._io().submit(self._write, key, entry)
+
+    def prune(self) -> int:
+        """
+        Delete expired entries from the on-disk store; returns how many were removed.
+        """
+        if not self.folder:
+            return 0
+        removed = 0
+        now = time.time()
+        for a, b, c in os.walk(self.folder):
+            for name in c:
+                path = os.path.join(a, name)
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        expires = json.load(f)["expires"]
+                except (OSError, ValueError, KeyError):
+                    expires = 0
+                if expires <= now:
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl,
+            "disk": self.folder,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+    def _fromMemory(self, key:str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+        return None
+
+    def _fromDisk(self, key:str):
+        entry = self._read(key)
+        with self._lock:
+            if entry is not None and entry[0] > time.time():
+                self.disk_hits += 1
+                self._remember(key, entry)
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def _io(self):
+        with self._lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache")
+            return self._executor
+
+    def _remember(self, key:str, entry:tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.folder, key[:2], f"{key}.json")
+
+    def _read(self, key:str):
+        if not self.folder:
+            return None
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data["expires"], data["value"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write(self, key:str, entry:tuple):
+        if not self.folder:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a crash never leaves a half-written entry behind
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"expires": entry[0], "value": entry[1]}, f)
+        os.replace(tmp, path)
+
+# The cache shared by the request handlers in this process
+cache = PredictionCache()
@@ -0,0 +1,102 @@
+"""
+Load-adaptive model cascade.
+
+Most uploads are clear photos that a small model (e.g. yolo11n trained on the same
+dataset: `python run.py train --model_name=yolo11n --name=nano`) identifies with
+confidence. In cascade mode the small model answers first, and an image is escalated
+to the large model (DEFAULT_MODEL) only when the small model's top score is below
+the threshold, or when it found nothing. When the server has spare capacity (nothing
+queued and a worker free), images go straight to the large model: accuracy costs
+nothing then.
+
+Both tiers run through the shared batcher, so small-model requests batch together and
+results are cached per model. Per-tier answer rates, escalation reasons and latency are
+reported in /stats and /metrics.
+
+Settings (environment variables):
+    CASCADE_SMALL_MODEL(str, Default: None): the small model (anything registry.resolveModel accepts); cascade mode is off if not set.
+    CASCADE_THRESHOLD(float, Default: 0.5): top score below which the small model's answer is escalated.
+    CASCADE_SPARE(bool, Default: 1): send images straight to the large model while the server has spare capacity.
+"""
+import os
+import time
+
+TIERS = ("small", "large")
+
+class Cascade:
+    def __init__(self, small:str=None, threshold:float=None, spare:bool=None):
+        self.small = small if small is not None else os.environ.get("CASCADE_SMALL_MODEL")
+        self.threshold = threshold if threshold is not None else float(os.environ.get("CASCADE_THRESHOLD", 0.5))
+        self.spare = spare if spare is not None else os.environ.get("CASCADE_SPARE", "1") not in ("0", "false", "False")
+        # Metrics
+        self.answered = dict.fromkeys(TIERS, 0) # requests answered by each tier
+        self.latency = dict.fromkeys(TIERS, 0.0) # total seconds of the requests answered by each tier
+        self.reasons = {"confident": 0, "low_confidence": 0, "spare_capacity": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.small)
+
+    def models(self, large:str) -> tuple:
+        """
+        Paths of the (small, large) models, or None if either is not available.
+        """
+        from registry import resolveModel
+        small = resolveModel(self.small)
+        if small is None or large is None:
+            return None
+        return small, large
+
+    def hasSpareCapacity(self) -> bool:
+        from batching import batcher
+        from workers import pool
+        return batcher.backlog == 0 and pool.inflight < pool.workers
+
+    async def submit(self, small:str, large:str, image, conf:float=0.25, timings=None, deadline:float=None) -> tuple:
+        """
+        Run `image` through the cascade; returns (detections, tier) where tier is "small" or "large".
+        deadline(float, Default=None): Unix time after which neither tier is run (see batching.MicroBatcher.submit).
+        """
+        from batching import batcher
+        from metrics import metrics
+
+        start = time.perf_counter()
+        if self.spare and self.hasSpareCapacity():
+            reason = "spare_capacity"
+        else:
+            result = await batcher.submit(small, image, conf, timings=timings, deadline=deadline)
+            top = max(result["scores"], default=0.0)
+            reason = "confident" if top >= self.threshold else "low_confidence"
+        if reason != "confident":
+            # Escalated images have already been through the quality gate on their way to the small model
+            result = await batcher.submit(large, image, conf, timings=timings, screen=reason == "spare_capacity", deadline=deadline)
+        tier = "small" if reason == "confident" else "large"
+
+        took = time.perf_counter() - start
+        self.reasons[reason] += 1
+        self.answered[tier] += 1
+        self.latency[tier] += took
+        metrics.observe("ai_cascade_seconds", took, tier=tier)
+        return result, tier
+
+    def stats(self) -> dict:
+        total = sum(self.answered.values())
+        return {
+            "enabled": self.enabled,
+            "small_model": self.small,
+            "threshold": self.threshold,
+            "spare_capacity_to_large": self.spare,
+            "requests": total,
+            "tiers": {
+                tier: {
+                    "answered": self.answered[tier],
+                    "rate": round(self.answered[tier] / total, 4) if total else 0.0,
+                    "mean_ms": round(self.latency[tier] / self.answered[tier] * 1000, 2) if self.answered[tier] else 0.0,
+                }
+                for tier in TIERS
+            },
+            "reasons": dict(self.reasons),
+        }
+
+# The cascade of this process
+cascade = Cascade()
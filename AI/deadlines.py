@@ -0,0 +1,82 @@
+"""
+Request deadlines, so that work nobody is waiting for any more is dropped.
+
+The backend proxy (backend/app/api/routes/ai.py) gives up on a prediction after its timeout,
+but the AI server used to run it to the end anyway: under overload, most of its work went to
+clients that had already left. The proxy now sends the moment it gives up, as Unix time in seconds:
+    X-Request-Deadline: 1760700000.25
+and work is dropped at two points:
+    queue       an image whose deadline has passed is not run: on arrival, or when its batch is
+                formed (see batching.py). The request is answered 504.
+    serialize   the response is not encoded when the deadline has passed or the client has
+                disconnected while the image was running.
+Requests without the header are never dropped. When identical uploads share one run (see
+batching.MicroBatcher.submit), it is dropped only once every one of them has expired.
+Dropped work, by stage and reason, is in /stats and /metrics.
+The deadline is compared to this machine's clock, so the proxy's and the AI server's clocks must agree (NTP).
+"""
+import time
+
+HEADER = "X-Request-Deadline"
+
+# (stage, reason) of the work dropped
+DROPS = (("queue", "deadline"), ("serialize", "deadline"), ("serialize", "disconnected"))
+
+class DeadlineExceeded(Exception):
+    """
+    Raised by `batching.MicroBatcher.submit` when the deadline of an image passes before it is run.
+    """
+    def __init__(self, message:str="The request deadline passed before it was run."):
+        super().__init__(message)
+
+def parse(value:str) -> float:
+    """
+    The deadline in an X-Request-Deadline header value; None without one, or if it is not a number.
+    """
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+def expired(deadline:float, now:float=None) -> bool:
+    """
+    Whether `deadline` (Unix time, None for no deadline) has passed.
+    """
+    return deadline is not None and (now if now is not None else time.time()) >= deadline
+
+def latest(a:float, b:float) -> float:
+    """
+    The later of two deadlines, where None (no deadline) is later than any.
+    """
+    return None if a is None or b is None else max(a, b)
+
+class DroppedWork:
+    def __init__(self):
+        self.counts = dict.fromkeys(DROPS, 0)
+
+    def record(self, stage:str, reason:str):
+        self.counts[stage, reason] += 1
+
+    async def abandoned(self, request, deadline:float=None, stage:str="serialize") -> str:
+        """
+        Why nobody is waiting for the response to `request` any more: "deadline", "disconnected",
+        or None if someone still is. Recorded as work dropped at `stage`.
+        """
+        if expired(deadline):
+            reason = "deadline"
+        elif await request.is_disconnected():
+            reason = "disconnected"
+        else:
+            return None
+        self.record(stage, reason)
+        return reason
+
+    def stats(self) -> dict:
+        stats = {}
+        for (stage, reason), n in self.counts.items():
+            stats.setdefault(stage, {})[reason] = n
+        stats["total"] = sum(self.counts.values())
+        return stats
+
+# The work dropped by this process
+dropped = DroppedWork()
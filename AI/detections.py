@@ -0,0 +1,92 @@
+"""
+Detections of one image, kept as columns.
+
+Backends take boxes, classes and scores straight from the model output arrays and return
+them as one dict of columns; nothing on the hot path builds a dict per box or goes
+through a JSON round trip:
+    {"boxes": [[x1, y1, x2, y2], ...], "classes": [0, ...], "scores": [0.91234, ...], "names": {"0": "lantana"}}
+Boxes are in original-image pixels and `names` only lists the classes present. This is
+also the compact response format. The default response is still one dict per box, as
+Ultralytics' `Results.to_json()` made it (see `rows`).
+
+Response formats, chosen by the Accept header (see `negotiate`):
+    application/json (default)                    rows
+    application/vnd.invastop.columnar+json        columns
+    application/msgpack, application/x-msgpack    columns as MessagePack, if `msgpack` is installed
+"""
+import json
+
+DECIMALS = 5 # rounding used by Results.to_json()
+
+JSON = "application/json"
+COLUMNAR_JSON = "application/vnd.invastop.columnar+json"
+MSGPACK = "application/msgpack"
+
+def columns(boxes, classes, scores, names:dict) -> dict:
+    """
+    Build the columns of one image from arrays of boxes (n, 4) in x1, y1, x2, y2 order, class ids (n,) and scores (n,).
+    names: class id -> name of the model.
+    """
+    import numpy as np
+
+    classes = np.asarray(classes).astype(np.int64).tolist()
+    return {
+        # float64 before rounding, so that the values are the ones a float32 -> float -> round() gives
+        "boxes": np.asarray(boxes, dtype=np.float64).reshape(-1, 4).round(DECIMALS).tolist(),
+        "classes": classes,
+        "scores": np.asarray(scores, dtype=np.float64).round(DECIMALS).tolist(),
+        "names": {str(c): names.get(c, str(c)) for c in sorted(set(classes))},
+    }
+
+def rows(detections:dict) -> list:
+    """
+    The default response format: one dict per box, as `Results.to_json()` gives them.
+    """
+    names = detections["names"]
+    return [
+        {
+            "name": names.get(str(c), str(c)),
+            "class": c,
+            "confidence": score,
+            "box": {"x1": box[0], "y1": box[1], "x2": box[2], "y2": box[3]},
+        }
+        for box, c, score in zip(detections["boxes"], detections["classes"], detections["scores"])
+    ]
+
+def scale(detections:dict, sx:float, sy:float) -> dict:
+    """
+    A copy of `detections` with the boxes scaled by sx horizontally and sy vertically.
+    """
+    boxes = [
+        [round(x1 * sx, DECIMALS), round(y1 * sy, DECIMALS), round(x2 * sx, DECIMALS), round(y2 * sy, DECIMALS)]
+        for x1, y1, x2, y2 in detections["boxes"]
+    ]
+    return {**detections, "boxes": boxes}
+
+def negotiate(accept:str=None) -> str:
+    """
+    The response media type for an Accept header: the first compact format listed that is available, else JSON rows.
+    """
+    for item in (accept or "").split(","):
+        media_type = item.split(";")[0].strip().lower()
+        if media_type == COLUMNAR_JSON:
+            return COLUMNAR_JSON
+        if media_type in (MSGPACK, "application/x-msgpack"):
+            try:
+                import msgpack
+            except ImportError:
+                continue
+            return MSGPACK
+    return JSON
+
+def render(detections:dict, media_type:str=JSON) -> bytes:
+    """
+    Encode the detections of one image as `media_type` (see `negotiate`).
+    """
+    if media_type == MSGPACK:
+        import msgpack
+        # Single precision floats: exact enough for pixels and scores, and 5 bytes each instead of 9
+        return msgpack.packb(detections, use_single_float=True)
+    content = detections if media_type == COLUMNAR_JSON else rows(detections)
+    # Same encoding as FastAPI's JSONResponse
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,219 @@
+"""
+Image decoding helpers shared by `run.predict` and the inference servers.
+
+Phone photos are often 12 MP or more, while the model only ever sees a 640 px
+letterbox. When the target size is known, JPEGs are decoded with libjpeg's DCT
+scaling (`Image.draft`) at the smallest 1/2, 1/4 or 1/8 scale that is still at
+least as large as the letterbox, which cuts both decode time and the memory held
+by the decoded frame. The original size is kept in `im.info["original_size"]`
+and `restoreBoxes` maps detections back to original-image pixels.
+
+Settings (environment variables):
+    DECODE_DRAFT(bool, Default: 1): decode JPEGs at reduced resolution when the target size is known.
+"""
+import io
+import os
+import math
+import threading
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+DRAFT = os.environ.get("DECODE_DRAFT", "1") not in ("0", "false", "False")
+
+# Per-thread scratch arrays reused across batches, see `scratch`
+_scratch = threading.local()
+
+def _draft(im, size:int):
+    """
+    Ask the JPEG decoder for the smallest DCT scale that still covers a `size` letterbox of `im`.
+    Records the size of the file in `im.info["original_size"]`; must be called before the image is loaded.
+    """
+    w, h = im.size
+    im.info["original_size"] = (w, h)
+    gain = min(size / w, size / h)
+    if not DRAFT or im.format != "JPEG" or gain >= 0.5:
+        return im
+    im.draft("RGB", (math.ceil(w * gain), math.ceil(h * gain)))
+    return im
+
+def decode(data, size:int=None):
+    """
+    Decode an encoded image (JPEG/PNG/WEBP...) straight from memory.
+    data: bytes, bytearray or memoryview holding the encoded file.
+    size(int, Default=None): letterbox size the image is decoded for; JPEGs are then decoded at reduced resolution.
+    """
+    from PIL import Image
+    im = Image.open(io.BytesIO(data))
+    if size:
+        _draft(im, size)
+    im.load()
+    return im
+
+def openImage(img, size:int=None):
+    """
+    Open `img`, which may be a path, the raw bytes of an encoded image or an already opened PIL image.
+    size(int, Default=None): see `decode`. Already opened images are returned as they are.
+    """
+    from PIL import Image
+    if isinstance(img, Image.Image):
+        return img
+    if isinstance(img, (bytes, bytearray, memoryview)):
+        return decode(img, size)
+    im = Image.open(img)
+    if size:
+        _draft(im, size)
+    return im
+
+class UndecodableImage(ValueError):
+    """
+    Raised by `loadImage` when an upload is not an image that can be decoded, e.g. an unknown format or a truncated file.
+    """
+
+def loadImage(img, size:int=None):
+    """
+    `openImage`, then decode the pixels at once (files are opened lazily); raises `UndecodableImage` if they cannot be.
+    """
+    from PIL import Image
+    try:
+        im = openImage(img, size)
+        im.load()
+    # ImportError: Ultralytics' Image.open falls back to a HEIF plugin that may not be installed
+    except (OSError, SyntaxError, ImportError, Image.DecompressionBombError) as e:
+        raise UndecodableImage("The upload could not be read as an image.") from e
+    return im
+
+def originalSize(im) -> tuple:
+    """
+    (width, height) of the file `im` was decoded from, which differs from `im.size` after a reduced-resolution decode.
+    """
+    return im.info.get("original_size", im.size)
+
+def restoreBoxes(detections:dict, im) -> dict:
+    """
+    Scale detection columns (see detections.py) made on `im` back to the pixels of its original file.
+    Nothing changes unless `im` was decoded at reduced resolution.
+    """
+    from detections import scale
+    (ow, oh), (w, h) = originalSize(im), im.size
+    if (ow, oh) == (w, h):
+        return detections
+    return scale(detections, ow / w, oh / h)
+
+def scratch(name:str, shape:tuple, dtype):
+    """
+    A scratch array of `shape` owned by the calling thread, reused by the next call with the same name.
+    Its content is overwritten by that call: copy anything that has to outlive it.
+    """
+    import numpy as np
+
+    buffers = _scratch.__dict__
+    buf = buffers.get(name)
+    if buf is None or buf.dtype != dtype or buf.shape[1:] != tuple(shape[1:]) or len(buf) < shape[0]:
+        buf = buffers[name] = np.empty(shape, dtype=dtype)
+    return buf[:shape[0]]
+
+def _geometry(w:int, h:int, size:int, stride:int=None) -> tuple:
+    """
+    Letterbox layout of a w x h image: (gain, resized (w, h), canvas (w, h)).
+    """
+    gain = min(size / w, size / h)
+    nw, nh = round(w * gain), round(h * gain)
+    if stride is None:
+        return gain, (nw, nh), (size, size)
+    return gain, (nw, nh), (nw + (size - nw) % stride, nh + (size - nh) % stride)
+
+def letterbox(im, size:int=640, stride:int=None, color:int=114, out=None):
+    """
+    Resize a PIL image to fit in a `size` x `size` square, keeping its aspect ratio, and pad the rest with gray as Ultralytics does.
+    stride(int, Default=None): if given, only pad up to the next multiple of `stride` (Ultralytics' rectangular "auto" mode).
+    out(ndarray, Default=None): uint8 array of shape (h, w, 3) to draw into instead of a new one.
+    Returns (array, gain, (pad_x, pad_y)): an RGB uint8 array of shape (h, w, 3),
+    and how to map its coordinates back, original = (letterboxed - pad) / gain.
+    """
+    import cv2
+    import numpy as np
+
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    w, h = im.size
+    gain, (nw, nh), (cw, ch) = _geometry(w, h, size, stride)
+    left, top = round((cw - nw) / 2 - 0.1), round((ch - nh) / 2 - 0.1)
+    pixels = np.asarray(im)
+    if (nw, nh) != (w, h):
+        # cv2 rather than PIL: same interpolation as Ultralytics, so both backends see identical inputs
+        pixels = cv2.resize(pixels, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    canvas = np.empty((ch, cw, 3), dtype=np.uint8) if out is None else out
+    canvas.fill(color)
+    canvas[top:top + nh, left:left + nw] = pixels
+    # Same rounding as Ultralytics uses when scaling boxes back
+    pad = round((cw - w * gain) / 2 - 0.1), round((ch - h * gain) / 2 - 0.1)
+    return canvas, gain, pad
+
+def letterboxBatch(images:list, size:int=640, stride:int=None, color:int=114) -> tuple:
+    """
+    Letterbox several PIL images into one (n, h, w, 3) uint8 array, reused by the next call from the same thread.
+    With `stride`, all images must share one letterbox shape (e.g. they all have the same size).
+    Returns (array, [(gain, pad)]), see `letterbox`.
+    """
+    import numpy as np
+
+    shapes = {_geometry(*im.size, size, stride)[2] for im in images}
+    if len(shapes) != 1:
+        raise ValueError(f"Images letterbox to different shapes {sorted(shapes)}: batch them without `stride`.")
+    cw, ch = shapes.pop()
+    batch = scratch("letterbox", (len(images), ch, cw, 3), np.uint8)
+    transforms = []
+    for im, out in zip(images, batch):
+        _, gain, pad = letterbox(im, size, stride, color, out=out)
+        transforms.append((gain, pad))
+    return batch, transforms
+
+def isZip(data) -> bool:
+    """
+    Whether `data` is a zip archive (checked by its magic number, not by the file name).
+    """
+    return bytes(data[:4]) == b"PK\x03\x04"
+
+def unzipImages(data, limit:int=None, max_bytes:int=None, max_total:int=None) -> list:
+    """
+    Extract the images in a zip archive held in memory.
+    Returns [(name, bytes)] in archive order; folders and non-image members are skipped.
+    Raises `uploads.UploadTooLarge` as soon as a member decompresses to more than `max_bytes`
+    (Default: os.environ["UPLOAD_MAX_BYTES"]), or all of them to more than `max_total` (Default: os.environ["BATCH_MAX_BYTES"]).
+    Members are decompressed at most one byte past the limit, whatever sizes the archive declares.
+    """
+    import zipfile
+    from uploads import BATCH_MAX_BYTES, MAX_BYTES, UploadTooLarge
+    max_bytes = max_bytes or MAX_BYTES
+    max_total = max_total if max_total is not None else BATCH_MAX_BYTES
+    images = []
+    total = 0
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTS):
+                continue
+            if limit is not None and len(images) >= limit:
+                break
+            if info.file_size > max_bytes:
+                raise UploadTooLarge(max_bytes)
+            with archive.open(info) as member:
+                content = member.read(max_bytes + 1)
+            if len(content) > max_bytes:
+                raise UploadTooLarge(max_bytes)
+            total += len(content)
+            if total > max_total:
+                raise UploadTooLarge(max_total)
+            images.append((info.filename, content))
+    return images
+
+def saveUpload(data, filename:str, folder:str) -> str:
+    """
+    Write an upload to `folder` under a unique name and return its path.
+    Only used when debugging uploads: the normal path never touches the disk.
+    """
+    import uuid
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{uuid.uuid4().hex}_{os.path.basename(filename or 'upload')}")
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
@@ -0,0 +1,129 @@
+"""
+Live detection over a WebSocket, for scouting with the camera running.
+
+The client sends JPEG frames as binary messages and gets one JSON message back per
+processed frame:
+    {"seq": 12, "detections": [...], "dropped": 3, "latency_ms": 41.2}
+`seq` numbers the frames received on the connection, starting at 0, and `dropped`
+counts the frames skipped since the previous reply. Only the newest frame is ever
+waiting: when inference falls behind, a frame that arrives before the previous one
+was picked up replaces it, so replies always describe what the camera sees now
+instead of lagging further and further behind.
+
+Frames go through `batching.batcher`, so frames from several cameras share batches,
+the inference pool and its admission control. A frame rejected because the server is
+busy is answered with {"seq": ..., "error": ..., "retry_after": ...} and skipped.
+"""
+import time
+import asyncio
+
+class LiveSession:
+    """
+    One camera connection: a receiver that keeps only the newest frame, and a loop that runs it.
+    """
+    def __init__(self, websocket, model:str, conf:float=0.25):
+        self.websocket = websocket
+        self.model = model
+        self.conf = conf
+        self._frame = None # (seq, received at, bytes) of the newest frame not picked up yet
+        self._arrived = asyncio.Event()
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self._dropped_since_reply = 0
+
+    async def serve(self, streams=None):
+        """
+        Run until the client disconnects.
+        """
+        from starlette.websockets import WebSocketDisconnect
+
+        infer = asyncio.create_task(self._infer(streams))
+        try:
+            while True:
+                data = await self.websocket.receive_bytes()
+                if self._frame is not None:
+                    # Inference is behind: the waiting frame is stale now
+                    self.dropped += 1
+                    self._dropped_since_reply += 1
+                    if streams is not None:
+                        streams.dropped += 1
+                self._frame = (self.received, time.perf_counter(), data)
+                self.received += 1
+                if streams is not None:
+                    streams.received += 1
+                self._arrived.set()
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        finally:
+            infer.cancel()
+            await asyncio.gather(infer, return_exceptions=True)
+
+    async def _infer(self, streams=None):
+        from batching import batcher
+        from detections import rows
+        from metrics import Timings
+        from workers import Busy
+
+        while True:
+            await self._arrived.wait()
+            self._arrived.clear()
+            seq, received, data = self._frame
+            self._frame = None
+            reply = {"seq": seq}
+            timings = Timings()
+            try:
+                # Not screened by the quality gate: a blurred frame is followed by a sharp one a moment later.
+                # Not cached either: a frame is never sent twice
+                reply["detections"] = rows(await batcher.submit(self.model, data, self.conf, timings=timings, screen=False, cache=False))
+            except Busy as e:
+                reply["error"] = "Server is busy, frame skipped."
+                reply["retry_after"] = e.retry_after
+            except Exception as e:
+                # A corrupt frame must not end the stream
+                reply["error"] = f"Could not process frame: {e}"
+            else:
+                timings.finish("live")
+                self.processed += 1
+                if streams is not None:
+                    streams.processed += 1
+            reply["dropped"] = self._dropped_since_reply
+            reply["latency_ms"] = round((time.perf_counter() - received) * 1000, 2)
+            self._dropped_since_reply = 0
+            await self.websocket.send_json(reply)
+
+class LiveStreams:
+    """
+    The open camera connections and their frame counters.
+    """
+    def __init__(self):
+        self.sessions = set()
+        # Metrics
+        self.connections = 0
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+
+    async def serve(self, websocket, model:str, conf:float=0.25):
+        """
+        Serve an accepted WebSocket until the client disconnects.
+        """
+        session = LiveSession(websocket, model, conf)
+        self.sessions.add(session)
+        self.connections += 1
+        try:
+            await session.serve(self)
+        finally:
+            self.sessions.discard(session)
+
+    def stats(self) -> dict:
+        return {
+            "open": len(self.sessions),
+            "connections": self.connections,
+            "frames_received": self.received,
+            "frames_processed": self.processed,
+            "frames_dropped": self.dropped,
+        }
+
+# The camera connections of this process
+streams = LiveStreams()
@@ -0,0 +1,228 @@
+"""
+Per-stage request timing and Prometheus metrics for the inference servers.
+
+A request is timed in stages:
+    read         reading the upload from the client
+    queue        waiting for a batch and then for a free worker
+    decode       decoding the image
+    preprocess   letterbox and normalisation
+    forward      the forward pass
+    postprocess  NMS, rescaling boxes and building the detections
+    serialize    encoding the JSON response
+Stages that run on a worker are recorded with `span` while `collect` is active (see
+workers._timed) and travel back with the job's result, so thread and process workers
+report alike. The stages of a batch are charged in full to every request in it: that is
+the latency each of them saw. A request's `Timings` go back to the client in a
+`Server-Timing` header and into histograms, which `/metrics` exposes in the Prometheus
+text format together with queue depths, resident models and cache counters.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+STAGES = ("read", "queue", "decode", "preprocess", "forward", "postprocess", "serialize")
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+@contextmanager
+def collect():
+    """
+    Collect the spans recorded by this thread into a dict {stage: seconds}, which is yielded.
+    """
+    previous = getattr(_local, "stages", None)
+    _local.stages = stages = {}
+    try:
+        yield stages
+    finally:
+        _local.stages = previous
+
+def record(name:str, seconds:float):
+    """
+    Add `seconds` to stage `name` of the job being collected in this thread, if any.
+    """
+    stages = getattr(_local, "stages", None)
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+@contextmanager
+def span(name:str):
+    """
+    Time the block as stage `name` of the job being collected in this thread; free when nothing is collected.
+    """
+    if getattr(_local, "stages", None) is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+class Timings:
+    """
+    Stage durations of one request.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    def record(self, name:str, seconds:float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def merge(self, stages:dict):
+        for name, seconds in stages.items():
+            self.record(name, seconds)
+
+    @contextmanager
+    def span(self, name:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def header(self) -> str:
+        """
+        The stages as a Server-Timing header value, in milliseconds, plus the total so far.
+        """
+        spans = [f"{name};dur={self.stages[name] * 1000:.2f}" for name in STAGES if name in self.stages]
+        spans.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.2f}")
+        return ", ".join(spans)
+
+    def finish(self, endpoint:str):
+        """
+        Add this request to the stage and request latency histograms.
+        """
+        for name, seconds in self.stages.items():
+            metrics.observe("ai_stage_seconds", seconds, stage=name, endpoint=endpoint)
+        metrics.observe("ai_request_seconds", time.perf_counter() - self.start, endpoint=endpoint)
+
+class Histogram:
+    """
+    A Prometheus histogram: cumulative bucket counts, sum and count.
+    """
+    def __init__(self, buckets:tuple=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name:str, labels:str) -> list:
+        sep = "," if labels else ""
+        lines = [f'{name}_bucket{{{labels}{sep}le="{bound}"}} {n}' for bound, n in zip(self.buckets, self.counts)]
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def _labels(labels:dict) -> str:
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+
+class Metrics:
+    """
+    Latency histograms of this process, and the Prometheus text rendering of them plus the servers' gauges.
+    """
+    HELP = {
+        "ai_stage_seconds": "Time spent in each stage of a request.",
+        "ai_request_seconds": "Total time to answer a request.",
+        "ai_cascade_seconds": "Time to answer a cascade request, by the tier that answered it.",
+    }
+
+    def __init__(self):
+        self._histograms = {} # (name, labels) -> Histogram
+        self._lock = threading.Lock()
+
+    def observe(self, name:str, value:float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format.
+        Waits for the process workers' model stats (see workers.InferencePool.modelStats): call it off the event loop.
+        """
+        lines = []
+        with self._lock:
+            names = sorted({name for name, _ in self._histograms})
+            for name in names:
+                lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for (n, labels), histogram in sorted(self._histograms.items()):
+                    if n == name:
+                        lines.extend(histogram.lines(name, labels))
+        for name, kind, text, samples in self._gauges():
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{{{_labels(labels)}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _gauges(self) -> list:
+        """
+        Current state of the batcher, worker pool, model registry, prediction cache, live streams, cascade, quality gate and dropped work,
+        as [(name, type, help, [(labels, value)])].
+        """
+        from batching import batcher
+        from cache import cache
+        from cascade import cascade
+        from deadlines import dropped
+        from live import streams
+        from quality import gate
+        from workers import pool
+
+        batching, workers, models, cached, live = batcher.stats(), pool.stats(), pool.modelStats(), cache.stats(), streams.stats()
+        tiers, screened = cascade.stats(), gate.stats()
+        return [
+            ("ai_batch_queue_depth", "gauge", "Images waiting for a batch.", [({}, batching["queue_depth"])]),
+            ("ai_batches_total", "counter", "Batches run.", [({}, batching["batches"])]),
+            ("ai_batch_images_total", "counter", "Images run in batches.", [({}, batching["images"])]),
+            ("ai_batch_rejected_total", "counter", "Images rejected because the batch queue was full.", [({}, batching["rejected"])]),
+            ("ai_batch_deduplicated_total", "counter", "Images not run because an identical one was already running.", [({}, batching["deduplicated"])]),
+            ("ai_pool_workers", "gauge", "Inference workers.", [({"executor": workers["executor"]}, workers["workers"])]),
+            ("ai_pool_running", "gauge", "Jobs running on a worker.", [({}, workers["running"])]),
+            ("ai_pool_queue_depth", "gauge", "Jobs waiting for a worker.", [({}, workers["queue_depth"])]),
+            ("ai_pool_jobs_total", "counter", "Jobs run by the inference pool.", [({}, workers["jobs"])]),
+            ("ai_pool_rejected_total", "counter", "Jobs rejected because the pool queue was full.", [({}, workers["rejected"])]),
+            ("ai_pool_restarts_total", "counter", "Worker processes replaced after they died.", [({}, workers["restarts"])]),
+            ("ai_models_loaded", "gauge", "Resident models, counted once per process worker holding them.", [({}, len(models["models"]))]),
+            ("ai_model_bytes", "gauge", "Memory held by each resident model, by process worker.",
+                [({"path": m["path"], "backend": m["backend"], **({"worker": str(m["worker"])} if "worker" in m else {})}, m["bytes"]) for m in models["models"]]),
+            ("ai_models_budget_bytes", "gauge", "Memory budget for resident models, per process worker.", [({}, models["budget_bytes"])]),
+            ("ai_model_swaps_total", "counter", "New weights swapped in for a served model.", [({}, models["swaps"])]),
+            ("ai_cache_entries", "gauge", "Predictions held in the in-memory cache.", [({}, cached["entries"])]),
+            ("ai_cache_hits_total", "counter", "Prediction cache hits.", [({"store": "memory"}, cached["hits"]), ({"store": "disk"}, cached["disk_hits"])]),
+            ("ai_cache_misses_total", "counter", "Prediction cache misses.", [({}, cached["misses"])]),
+            ("ai_live_streams", "gauge", "Open live camera streams.", [({}, live["open"])]),
+            ("ai_live_frames_total", "counter", "Live camera frames, by outcome.",
+                [({"outcome": k}, live[f"frames_{k}"]) for k in ("received", "processed", "dropped")]),
+            ("ai_cascade_answered_total", "counter", "Cascade requests, by the tier that answered them.",
+                [({"tier": tier}, row["answered"]) for tier, row in tiers["tiers"].items()]),
+            ("ai_cascade_routes_total", "counter", "Cascade routing decisions, by reason.",
+                [({"reason": reason}, n) for reason, n in tiers["reasons"].items()]),
+            ("ai_quality_checked_total", "counter", "Uploads screened by the quality gate, by outcome.",
+                [({"outcome": "pass"}, screened["passed"]), ({"outcome": "fail"}, screened["failed"])]),
+            ("ai_quality_failures_total", "counter", "Quality gate failures, by check.",
+                [({"check": check}, n) for check, n in screened["failures"].items()]),
+            ("ai_dropped_total", "counter", "Work dropped because nobody was waiting for it any more, by stage and reason.",
+                [({"stage": stage, "reason": reason}, n) for (stage, reason), n in dropped.counts.items()]),
+        ]
+
+# The metrics of this process
+metrics = Metrics()
@@ -0,0 +1,137 @@
+"""
+Staged request pipeline for thread workers.
+
+Without it, an upload is decoded on the inference worker right before its forward pass,
+and the response is encoded on the event loop, so the decode, forward pass and encoding
+of different requests never overlap. In the pipeline each has its own stage, joined to
+the next by a bounded queue:
+    decode     a thread pool decoding uploads for the model's input size (Pillow releases the GIL)
+    inference  the micro-batcher and inference pool (batching.py, workers.py), fed decoded images
+    serialize  a thread pool encoding responses (detections.render)
+so that image N+1 is decoded while image N is in the model. When a stage's queue is full,
+requests wait before entering it. Images waiting for or in the decode stage count towards the
+batcher's BATCH_QUEUE_SIZE, so that beyond it uploads are rejected at once instead of piling up
+in front of the stage with their bytes (see batching.MicroBatcher). The prediction cache and
+identical in-flight requests are still looked up before anything is decoded.
+Process workers keep decoding for themselves: sending decoded pixels to another process
+costs more than decoding them there.
+See `python bench.py pipeline` for throughput against the sequential path.
+
+Settings (environment variables):
+    PIPELINE(bool, Default: 1): run requests through the pipeline when the inference pool uses threads.
+    DECODE_WORKERS(int, Default: 2): decode threads.
+    SERIALIZE_WORKERS(int, Default: 1): serialization threads.
+    PIPELINE_DEPTH(int, Default: 16): most images in the decode stage, and most responses in the serialize stage, at once.
+"""
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+def _decode(model:str, data) -> tuple:
+    """
+    Decode an upload for the input size of `model`; returns (PIL image, seconds it took).
+    """
+    from imaging import loadImage
+    from registry import registry
+
+    start = time.perf_counter()
+    im = loadImage(data, registry.get(model).imgsz)
+    return im, time.perf_counter() - start
+
+def _serialize(detections:dict, media_type:str) -> tuple:
+    """
+    Encode a response; returns (body, seconds it took).
+    """
+    from detections import render
+
+    start = time.perf_counter()
+    body = render(detections, media_type)
+    return body, time.perf_counter() - start
+
+class Pipeline:
+    def __init__(self, enabled:bool=None, decode_workers:int=None, serialize_workers:int=None, depth:int=None):
+        if enabled is None:
+            enabled = os.environ.get("PIPELINE", "1") not in ("0", "false", "False")
+        self._enabled = enabled
+        self.decode_workers = decode_workers or int(os.environ.get("DECODE_WORKERS", 2))
+        self.serialize_workers = serialize_workers or int(os.environ.get("SERIALIZE_WORKERS", 1))
+        self.depth = depth or int(os.environ.get("PIPELINE_DEPTH", 16))
+        self._decoders = None
+        self._serializers = None
+        self.decoding = 0 # images waiting for or in the decode stage
+        # The bounded queues in front of the decode and serialize stages
+        self._decoding = asyncio.Semaphore(self.depth)
+        self._serializing = asyncio.Semaphore(self.depth)
+        # Metrics
+        self.decoded = 0
+        self.decode_total = 0.0
+        self.serialized = 0
+        self.serialize_total = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        from workers import pool
+        return self._enabled and pool.kind == "thread"
+
+    def start(self):
+        if self._decoders is None:
+            self._decoders = ThreadPoolExecutor(max_workers=self.decode_workers, thread_name_prefix="decode")
+            self._serializers = ThreadPoolExecutor(max_workers=self.serialize_workers, thread_name_prefix="serialize")
+
+    def shutdown(self):
+        for executor in (self._decoders, self._serializers):
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        self._decoders = self._serializers = None
+
+    async def decode(self, model:str, data, timings=None):
+        """
+        Decode an upload on the decode stage; the batcher's `decoder` (see batching.MicroBatcher).
+        timings(metrics.Timings, Default=None): gets the time spent waiting for a decode thread as "queue" and decoding as "decode".
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        queued = time.perf_counter()
+        self.decoding += 1
+        try:
+            async with self._decoding:
+                im, took = await loop.run_in_executor(self._decoders, _decode, model, data)
+        finally:
+            self.decoding -= 1
+        self.decoded += 1
+        self.decode_total += took
+        if timings is not None:
+            timings.record("queue", time.perf_counter() - queued - took)
+            timings.record("decode", took)
+        return im
+
+    async def serialize(self, detections:dict, media_type:str, timings=None) -> bytes:
+        """
+        Encode a response as `media_type` (see detections.render) on the serialize stage.
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        async with self._serializing:
+            body, took = await loop.run_in_executor(self._serializers, _serialize, detections, media_type)
+        self.serialized += 1
+        self.serialize_total += took
+        if timings is not None:
+            timings.record("serialize", took)
+        return body
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "decode_workers": self.decode_workers,
+            "serialize_workers": self.serialize_workers,
+            "depth": self.depth,
+            "decoding": self.decoding,
+            "decoded": self.decoded,
+            "mean_decode_ms": round(self.decode_total / self.decoded * 1000, 2) if self.decoded else 0.0,
+            "serialized": self.serialized,
+            "mean_serialize_ms": round(self.serialize_total / self.serialized * 1000, 2) if self.serialized else 0.0,
+        }
+
+# The pipeline of this process
+pipeline = Pipeline()
@@ -0,0 +1,139 @@
+"""
+Photo quality gate, run before an upload reaches the model.
+
+Many field uploads are blurry, black or tiny thumbnails, and the model finds nothing useful
+in them; a forward pass is wasted and the user gets an empty answer. The gate looks at a
+small grayscale copy of the upload (JPEGs are decoded straight at reduced resolution), which
+costs a few milliseconds, and fails it on:
+    resolution  the shorter side of the original image is below QUALITY_MIN_SIDE pixels
+    exposure    most pixels are crushed to black (too dark) or clipped to white (overexposed)
+    blur        the variance of the Laplacian of the copy is below QUALITY_BLUR
+Failing uploads are answered at once with a structured "retake photo" response instead of
+being run (see `RetakePhoto`). Pass and fail counts, by check, are in /stats and /metrics.
+Uploads that cannot be decoded at all are not the gate's business: they pass it, and decoding
+them for the model raises `imaging.UndecodableImage`, which the servers answer with 400 (the batch
+and live endpoints report it for that image). A retake would not help a file that is not an image.
+
+Settings (environment variables):
+    QUALITY_GATE(bool, Default: 1): screen uploads before running them.
+    QUALITY_MIN_SIDE(int, Default: 320): smallest accepted shorter side, in pixels.
+    QUALITY_BLUR(float, Default: 40): smallest accepted variance of the Laplacian, measured on the copy.
+    QUALITY_CLIPPED(float, Default: 0.8): largest accepted fraction of pixels that are black (<= 10) or white (>= 245).
+    QUALITY_SIZE(int, Default: 256): longer side of the copy the checks run on.
+"""
+import io
+import os
+import time
+import asyncio
+
+CHECKS = ("resolution", "exposure", "blur")
+
+MESSAGES = {
+    "resolution": "The photo is too small. Please take it with the camera, closer to the plant.",
+    "too_dark": "The photo is too dark. Please retake it in better light.",
+    "overexposed": "The photo is overexposed. Please retake it out of direct glare.",
+    "blur": "The photo is blurry. Please hold the camera steady and focus on the plant.",
+}
+
+class RetakePhoto(ValueError):
+    """
+    Raised by `batching.MicroBatcher.submit` when an upload fails the quality gate.
+    failures: [{"check", "reason", "value", "threshold", "message"}]
+    """
+    def __init__(self, failures:list):
+        super().__init__("; ".join(f["message"] for f in failures))
+        self.failures = failures
+
+    def response(self) -> dict:
+        """
+        The JSON payload answered to the client.
+        """
+        return {"error": "Please retake the photo.", "retake": True, "reasons": self.failures}
+
+def _failure(check:str, reason:str, value:float, threshold:float) -> dict:
+    return {"check": check, "reason": reason, "value": round(value, 2), "threshold": threshold, "message": MESSAGES[reason]}
+
+class QualityGate:
+    def __init__(self, enabled:bool=None, min_side:int=None, blur:float=None, clipped:float=None, size:int=None):
+        if enabled is None:
+            enabled = os.environ.get("QUALITY_GATE", "1") not in ("0", "false", "False")
+        self.enabled = enabled
+        self.min_side = min_side if min_side is not None else int(os.environ.get("QUALITY_MIN_SIDE", 320))
+        self.blur = blur if blur is not None else float(os.environ.get("QUALITY_BLUR", 40))
+        self.clipped = clipped if clipped is not None else float(os.environ.get("QUALITY_CLIPPED", 0.8))
+        self.size = size or int(os.environ.get("QUALITY_SIZE", 256))
+        # Metrics
+        self.passed = 0
+        self.failed = 0
+        self.failures = dict.fromkeys(CHECKS, 0)
+        self.check_total = 0.0
+
+    def check(self, data) -> list:
+        """
+        Run the checks on an encoded image; returns the failed ones (see `RetakePhoto`), [] if it passes.
+        Uploads that cannot be opened pass: the decoder rejects them with `imaging.UndecodableImage` (see above).
+        """
+        import numpy as np
+        from PIL import Image
+
+        start = time.perf_counter()
+        try:
+            im = Image.open(io.BytesIO(data))
+            width, height = im.size
+            im.draft("L", (self.size, self.size))
+            im = im.convert("L")
+        except Exception:
+            return []
+        im.thumbnail((self.size, self.size))
+        pixels = np.asarray(im, dtype=np.float32)
+
+        failures = []
+        if min(width, height) < self.min_side:
+            failures.append(_failure("resolution", "resolution", min(width, height), self.min_side))
+        dark = float((pixels <= 10).mean())
+        bright = float((pixels >= 245).mean())
+        if dark > self.clipped:
+            failures.append(_failure("exposure", "too_dark", dark, self.clipped))
+        elif bright > self.clipped:
+            failures.append(_failure("exposure", "overexposed", bright, self.clipped))
+        elif pixels.shape[0] > 2 and pixels.shape[1] > 2:
+            # Blur is only meaningful once the photo shows something
+            laplacian = pixels[1:-1, :-2] + pixels[1:-1, 2:] + pixels[:-2, 1:-1] + pixels[2:, 1:-1] - 4 * pixels[1:-1, 1:-1]
+            sharpness = float(laplacian.var())
+            if sharpness < self.blur:
+                failures.append(_failure("blur", "blur", sharpness, self.blur))
+
+        self.check_total += time.perf_counter() - start
+        if failures:
+            self.failed += 1
+            for failure in failures:
+                self.failures[failure["check"]] += 1
+        else:
+            self.passed += 1
+        return failures
+
+    async def screen(self, data):
+        """
+        Check an upload off the event loop; raises `RetakePhoto` if it fails.
+        """
+        failures = await asyncio.get_running_loop().run_in_executor(None, self.check, data)
+        if failures:
+            raise RetakePhoto(failures)
+
+    def stats(self) -> dict:
+        checked = self.passed + self.failed
+        return {
+            "enabled": self.enabled,
+            "min_side": self.min_side,
+            "blur": self.blur,
+            "clipped": self.clipped,
+            "checked": checked,
+            "passed": self.passed,
+            "failed": self.failed,
+            "fail_rate": round(self.failed / checked, 4) if checked else 0.0,
+            "failures": dict(self.failures),
+            "mean_ms": round(self.check_total / checked * 1000, 2) if checked else 0.0,
+        }
+
+# The quality gate of this process
+gate = QualityGate()
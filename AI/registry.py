@@ -0,0 +1,343 @@
+"""
+Process-wide registry of resident models.
+
+Loading YOLO weights and fusing their layers costs far more than a forward pass,
+so models are loaded once and kept warm between requests. PyTorch (.pt) and ONNX
+(.onnx) models are both served; see backends.py. Entries are keyed by the
+real path of the weights file and its mtime: re-pointing `latest.pt` or retraining
+into the same folder produces a new key.
+
+A new version of a model that is already being served is swapped in without downtime:
+the name it was requested by (e.g. `latest.pt`) keeps resolving to the old model
+while the new weights load and warm up on a background thread, then switches over
+at once. Requests already running on the old model finish on it; it is freed when
+the last one lets go. `watch` polls the served names so the swap happens as soon as
+`run.py updateModel` re-points the link, rather than on the next request. Variants are
+served by name too: `latest.pt:mmap` follows `latest.pt` to the new run's export.
+
+Settings (environment variables):
+    MODEL_MEMORY_MB(int, Default: 2048): memory budget for resident models; least recently used models are evicted beyond it.
+    MODEL_WARMUP(bool, Default: 1): run a warm-up inference right after loading.
+    MODEL_IMGSZ(int, Default: 640): image size used for the warm-up inference.
+    MODEL_WATCH_INTERVAL(float, Default: 2): seconds between checks of the served model files by `watch`; 0 disables it.
+"""
+import os
+import time
+import weakref
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+DEFAULT_MEMORY_BUDGET_MB = 2048
+DEFAULT_IMGSZ = 640
+
+# Served variants of a weights file, by name: `<model>:<variant>`
+VARIANTS = {
+    "pt": ".pt",
+    "onnx": ".onnx",
+    "int8": ".int8.onnx",
+    "mmap": ".safetensors",
+}
+
+_local = threading.local()
+
+@contextmanager
+def served():
+    """
+    Collect the registry keys of the models `ModelRegistry.get` returns in this thread into a list, which is yielded.
+    """
+    previous = getattr(_local, "served", None)
+    _local.served = keys = []
+    try:
+        yield keys
+    finally:
+        _local.served = previous
+
+def resolveModel(model:str, default:str=None, project:str="detect") -> str:
+    """
+    Turn a model name from a request into the name the registry serves it by, or None if there is no such file.
+    That is the path of the model file, or `<path>:<variant>` for a variant, which `modelPath` resolves
+    again whenever it is loaded, so that it follows e.g. `latest.pt` to new weights.
+    Accepted forms:
+        "latest.pt", "detect/<run>/weights/best.onnx"  a path
+        "<run>"                                        detect/<run>/weights/best.pt
+        "<model>:int8", "<model>:onnx", "<model>:mmap" that variant of <model>, e.g. "latest.pt:int8"
+                                                       (see `run.py quantize`, `run.py export` and `run.py exportSafetensors`)
+        "int8", "onnx", "mmap"                         that variant of `default`
+    """
+    if model is None:
+        model = default
+    if model is None:
+        return None
+    if model in VARIANTS and default is not None:
+        model = f"{default}:{model}"
+
+    name, _, variant = model.partition(":")
+    if not os.path.exists(name):
+        name = os.path.join(project, name, "weights", "best.pt")
+    if variant:
+        if variant not in VARIANTS:
+            return None
+        name = f"{name}:{variant}"
+    return name if os.path.exists(modelPath(name)) else None
+
+def modelPath(model:str) -> str:
+    """
+    The file a name returned by `resolveModel` points to now: `<path>:<variant>` is the variant's file next to the real `<path>`.
+    """
+    name, _, variant = model.partition(":")
+    if not variant:
+        return model
+    return os.path.splitext(os.path.realpath(name))[0] + VARIANTS[variant]
+
+class LoadedModel:
+    """
+    A resident model (a backend from backends.py) plus what the registry needs to know about it.
+    `lock` serialises inference: an Ultralytics predictor must not be shared by concurrent callers.
+    """
+    def __init__(self, backend, path:str, mtime:float):
+        self.backend = backend
+        self.path = path
+        self.mtime = mtime
+        self.nbytes = backend.nbytes
+        self.lock = threading.Lock()
+
+    @property
+    def names(self) -> dict:
+        return self.backend.names
+
+    @property
+    def imgsz(self) -> int:
+        """
+        Input size the model letterboxes images to; images are decoded for it.
+        """
+        return self.backend.imgsz
+
+    def detect(self, images:list, conf:float=0.25, imgsz:int=None) -> list:
+        """
+        Run one batch of PIL images; returns one list of detections per image.
+        """
+        with self.lock:
+            return self.backend.detect(images, conf=conf, imgsz=imgsz)
+
+class ModelRegistry:
+    """
+    LRU cache of `LoadedModel`s bounded by a memory budget.
+    The most recently used model is never evicted, even if it alone exceeds the budget.
+    """
+    def __init__(self, memory_budget_mb:int=None, warmup:bool=None, imgsz:int=None, watch_interval:float=None):
+        if memory_budget_mb is None:
+            memory_budget_mb = int(os.environ.get("MODEL_MEMORY_MB", DEFAULT_MEMORY_BUDGET_MB))
+        if warmup is None:
+            warmup = os.environ.get("MODEL_WARMUP", "1") not in ("0", "false", "False")
+        if imgsz is None:
+            imgsz = int(os.environ.get("MODEL_IMGSZ", DEFAULT_IMGSZ))
+        if watch_interval is None:
+            watch_interval = float(os.environ.get("MODEL_WATCH_INTERVAL", 2))
+        self.memory_budget = memory_budget_mb * 1024**2
+        self.warmup = warmup
+        self.imgsz = imgsz
+        self.watch_interval = watch_interval
+        self._models = OrderedDict() # (real path, mtime) -> LoadedModel
+        self._aliases = {} # path as requested, e.g. "latest.pt" -> key of the model it is served by
+        self._swapping = set() # keys being loaded in the background
+        self._failed = set() # keys whose background load failed; not retried
+        self._loading = {} # key -> concurrent.futures.Future of a load on the request path, awaited by other callers for it
+        self._lock = threading.RLock()
+        self._watcher = None
+        self.swaps = 0
+
+    @staticmethod
+    def key(path:str) -> tuple:
+        """
+        Registry key of a weights file: (real path, mtime). Symlinks such as `latest.pt` and variant names are resolved (see `modelPath`).
+        """
+        real = os.path.realpath(modelPath(path))
+        return real, os.path.getmtime(real)
+
+    def get(self, path:str) -> LoadedModel:
+        """
+        Return the resident model for `path`, loading it first if needed.
+        If `path` now points to new weights while an older version is being served, the older
+        version is returned until the new one has been loaded in the background (see `swap`).
+        Its key is then not `key(path)`: it is recorded for whoever collects `served` models.
+        """
+        loaded = self._get(path)
+        keys = getattr(_local, "served", None)
+        if keys is not None:
+            keys.append((loaded.path, loaded.mtime))
+        return loaded
+
+    def _get(self, path:str) -> LoadedModel:
+        from concurrent.futures import Future
+
+        key = self.key(path)
+        while True:
+            with self._lock:
+                loaded = self._models.get(key)
+                if loaded is not None:
+                    self._models.move_to_end(key)
+                    self._aliases[path] = key
+                    return loaded
+
+                current = self._models.get(self._aliases.get(path))
+                if current is not None:
+                    # New weights load in the background; if they failed to, the old model keeps serving
+                    if key not in self._failed:
+                        self.swap(path, key)
+                    return current
+
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = Future()
+                    break
+            # Another request is loading these weights: wait for it, then look again
+            loading.result()
+
+        # Loaded outside the lock, so that requests for models already resident are not held up meanwhile
+        try:
+            loaded = self._load(*key)
+        except Exception as e:
+            with self._lock:
+                del self._loading[key]
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            self._install(path, key, loaded)
+            del self._loading[key]
+        loading.set_result(loaded)
+        return loaded
+
+    def swap(self, path:str, key:tuple=None):
+        """
+        Load the weights `path` points to now (key `key`) on a background thread, then switch `path` over to them.
+        """
+        key = key or self.key(path)
+        with self._lock:
+            if key in self._swapping or key in self._models:
+                return
+            self._swapping.add(key)
+
+        def run():
+            try:
+                loaded = self._load(*key)
+            except Exception as e:
+                print(f" [ Could not load new weights {key[0]}: {e}; still serving the old model ]")
+                with self._lock:
+                    self._failed.add(key)
+                return
+            finally:
+                with self._lock:
+                    self._swapping.discard(key)
+            with self._lock:
+                old = self._aliases.get(path)
+                self._install(path, key, loaded)
+                self.swaps += 1
+            print(f" [ Swapped {path}: {old[0] if old else None} -> {key[0]} ]")
+
+        threading.Thread(target=run, name=f"swap {path}", daemon=True).start()
+
+    def watch(self, interval:float=None):
+        """
+        Start a background thread checking every `interval` seconds whether the files served by name
+        (e.g. `latest.pt`) point to new weights, and swapping them in if so.
+        """
+        interval = self.watch_interval if interval is None else interval
+        if interval <= 0 or (self._watcher is not None and self._watcher.is_alive()):
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                with self._lock:
+                    aliases = list(self._aliases.items())
+                for path, key in aliases:
+                    try:
+                        new = self.key(path)
+                    except OSError:
+                        continue # e.g. a link being replaced
+                    if new != key and new not in self._failed:
+                        self.swap(path, new)
+
+        self._watcher = threading.Thread(target=run, name="model watcher", daemon=True)
+        self._watcher.start()
+
+    def preload(self, path:str) -> LoadedModel:
+        """
+        Load `path` ahead of the first request, e.g. `DEFAULT_MODEL` at startup.
+        """
+        return self.get(path)
+
+    def loaded(self) -> list:
+        """
+        Paths of the resident models, least recently used first.
+        """
+        with self._lock:
+            return [m.path for m in self._models.values()]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "models": [{"path": m.path, "backend": m.backend.kind, "mtime": m.mtime, "bytes": m.nbytes} for m in self._models.values()],
+                "bytes": sum(m.nbytes for m in self._models.values()),
+                "budget_bytes": self.memory_budget,
+                "aliases": {path: key[0] for path, key in self._aliases.items()},
+                "swapping": [key[0] for key in self._swapping],
+                "swaps": self.swaps,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._aliases.clear()
+
+    def _install(self, path:str, key:tuple, loaded:LoadedModel):
+        """
+        Make `loaded` the model served for `path` and drop the versions nothing can reach any more:
+        older versions of the same file, and the model `path` pointed to before if no other name uses it.
+        Must be called with the lock held.
+        """
+        previous = self._aliases.get(path)
+        self._models[key] = loaded
+        self._aliases[path] = key
+        # Older versions of the same file can never be hit again: whatever named them now gets the new version
+        for alias, old in list(self._aliases.items()):
+            if old[0] == key[0]:
+                self._aliases[alias] = key
+        for old in [k for k in self._models if k != key and (k[0] == key[0] or k == previous)]:
+            if old in self._aliases.values():
+                continue
+            del self._models[old]
+            print(f" [ Retired model {old[0]} (mtime {old[1]}); it is freed once its last request finishes ]")
+        self._evict()
+
+    def _load(self, path:str, mtime:float) -> LoadedModel:
+        import time
+        import backends
+
+        print(f" [ Loading model {path} ... ]")
+        start = time.perf_counter()
+        loaded = LoadedModel(backends.load(path), path, mtime)
+        weakref.finalize(loaded, print, f" [ Freed model {path} (mtime {mtime}) ]").atexit = False
+        if self.warmup:
+            self._warmup(loaded)
+        print(f" [ Model {path} ready in {time.perf_counter() - start:.2f}s ({loaded.nbytes / 1024**2:.1f} MB) ]")
+        return loaded
+
+    def _warmup(self, loaded:LoadedModel):
+        """
+        Run one inference on a blank image so that fusing, predictor setup and
+        allocator warm-up happen here rather than on the first request.
+        """
+        from PIL import Image
+        loaded.detect([Image.new("RGB", (self.imgsz, self.imgsz))], imgsz=self.imgsz)
+
+    def _evict(self):
+        total = sum(m.nbytes for m in self._models.values())
+        while total > self.memory_budget and len(self._models) > 1:
+            key, loaded = self._models.popitem(last=False)
+            total -= loaded.nbytes
+            print(f" [ Evicted model {loaded.path} to stay within {self.memory_budget / 1024**2:.0f} MB ]")
+
+# The registry shared by everything in this process
+registry = ModelRegistry()
@@ -38,15 +38,111 @@ def __nextNum(category:str, dataset:str=DEFAULT_DATASET, starts_from:int=1) -> i
 def __makeLinkFor(target:str):
     """
     Make a symbolic link `latest.pt` pointing to `target`.
-    If `latest.pt` exists, remove it first.
+    The link is replaced atomically, so a running server never sees `latest.pt` missing (see registry.watch).
     """
-    try:
-        os.remove("latest.pt")
-    except FileNotFoundError:
-        pass
-    os.symlink(target, "latest.pt", target_is_directory=False)
+    tmp = f"latest.pt.{os.getpid()}.tmp"
+    os.symlink(target, tmp, target_is_directory=False)
+    os.replace(tmp, "latest.pt")
     print(f" [ latest.pt -> {target} ]")
 
+def __dataConfig(dataset:str=DEFAULT_DATASET) -> str:
+    """
+    The Ultralytics data config of a dataset folder: `<dataset>.yaml` if present, else `<dataset>.ndjson`.
+    """
+    yaml_path = os.path.join(dataset, f"{dataset}.yaml")
+    ndjson_path = os.path.join(dataset, f"{dataset}.ndjson")
+    if os.path.exists(yaml_path):
+        return yaml_path
+    if os.path.exists(ndjson_path):
+        return ndjson_path
+    return None
+
+def __splitImages(dataset:str=DEFAULT_DATASET, split:str=None) -> list:
+    """
+    Paths of the labelled images of a dataset, optionally only those in `split` ("train", "val" or "test") of its ndjson file.
+    """
+    ndjson_path = os.path.join(dataset, f"{dataset}.ndjson")
+    if not os.path.exists(ndjson_path):
+        return []
+    with open(ndjson_path, 'r', encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f.readlines()[1:] if line.strip()]
+    return [
+        os.path.join(dataset, entry["file"]) for entry in entries
+        if (split is None or entry.get("split") == split) and os.path.exists(os.path.join(dataset, entry["file"]))
+    ]
+
+def __latency(model:str, images:list, imgsz:int=640, warmup:int=3) -> dict:
+    """
+    Single-image latency of a model over `images`, in milliseconds (p50, p95, mean).
+    """
+    import time
+    from imaging import openImage
+    from registry import registry
+
+    loaded = registry.get(model)
+    ims = [openImage(img) for img in images]
+    for im in ims[:warmup]:
+        loaded.detect([im], imgsz=imgsz)
+    latencies = []
+    for im in ims:
+        start = time.perf_counter()
+        loaded.detect([im], imgsz=imgsz)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(round(q / 100 * (len(latencies) - 1))))]
+    return {
+        "p50_ms": round(pick(50), 2),
+        "p95_ms": round(pick(95), 2),
+        "mean_ms": round(sum(latencies) / len(latencies), 2),
+    }
+
+def __values(values, cast=int) -> list:
+    """
+    A sweep option as a list: fire turns "1,4,8" into a tuple, and a single value into a scalar.
+    """
+    if isinstance(values, (list, tuple)):
+        return [cast(v) for v in values]
+    return [cast(v) for v in str(values).split(",") if v != ""]
+
+def __benchmarkRun(path:str, images:list, batch:int, imgsz:int, threads:int, warmup:int=2) -> dict:
+    """
+    Throughput and latency of one benchmark configuration, run in a fresh process so that
+    the thread count applies from the start and peak memory belongs to this configuration alone.
+    """
+    import time
+    import resource
+
+    os.environ["ONNX_THREADS"] = str(threads)
+    os.environ["MODEL_WARMUP"] = "0"
+    from workers import pinThreads
+    pinThreads(threads)
+    from imaging import openImage
+    from registry import registry
+
+    loaded = registry.get(path)
+    ims = [openImage(img).convert("RGB") for img in images]
+    batches = [ims[i:i + batch] for i in range(0, len(ims), batch)]
+    for chunk in batches[:warmup]:
+        loaded.detect(chunk, imgsz=imgsz)
+
+    latencies = []
+    start = time.perf_counter()
+    for chunk in batches:
+        t = time.perf_counter()
+        loaded.detect(chunk, imgsz=imgsz)
+        latencies.append((time.perf_counter() - t) * 1000)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(round(q / 100 * (len(latencies) - 1))))]
+    return {
+        "images_per_sec": round(len(ims) / elapsed, 2),
+        "p50_ms": round(pick(50), 2),
+        "p95_ms": round(pick(95), 2),
+        "p99_ms": round(pick(99), 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
 ## exported functions
 def downloadImage(category, *urls, file:str=None, dataset:str=DEFAULT_DATASET):
     """
@@ -407,19 +503,21 @@ def train(dataset:str=DEFAULT_DATASET, model_name:str="yolo11m", epochs:int=50,
 
     print(f" [ Complete training task <{name}>. ]\n")
 
-def predict(model, img, visualize:bool=True):
+def predict(model, img, visualize:bool=True, conf:float=0.25, tile:bool=False):
     """
     Do a prediction using a given model.
+    model(str): path to the model file (.pt, or .onnx from `export`). It is loaded once and then kept resident by `registry`.
+    img(str | bytes): path to the image, or the encoded image itself (decoded in memory).
     If visualize=True, show the result after prediction finishes.
+    If tile=True, detect on overlapping full-resolution tiles (see `predictTiled`), for small plants in large photos.
     """
-    from PIL import Image, ImageDraw, ImageFont
-    from ultralytics import YOLO
+    from PIL import ImageDraw, ImageFont
+    from detections import rows
+    from imaging import openImage
 
-    im = Image.open(img)
+    im = openImage(img)
     w, h = im.size
-    model = YOLO(model)  # load a pretrained model (recommended for training)
-    results = model.predict(source=im, conf=0.25, save=False, save_txt=False, save_crop=False, line_width=3, hide_labels=False, hide_conf=False, verbose=False)
-    result = json.loads(results[0].to_json())
+    result = rows(predictColumns(model, [im], conf=conf, tile=tile)[0])
 
     if visualize:
         draw = ImageDraw.Draw(im)
@@ -447,6 +545,276 @@ def predict(model, img, visualize:bool=True):
 
     return result
 
+def predictBatch(model, imgs:list, conf:float=0.25) -> list:
+    """
+    Do one batched prediction over several images with a given model.
+    imgs(list): paths, encoded images (bytes) or PIL images.
+    Returns one list of detections per image, each in the same format as `predict`.
+    """
+    from detections import rows
+    return [rows(result) for result in predictColumns(model, imgs, conf=conf)]
+
+def predictTiled(model, img, conf:float=0.25) -> list:
+    """
+    Do a prediction on overlapping tiles of one high-resolution image, run as a single batch, with boxes merged across tiles.
+    img: a path, an encoded image (bytes) or a PIL image; it is decoded at full resolution.
+    Tile size and overlap are set in tiling.py. Returns detections in the same format as `predict`.
+    """
+    from detections import rows
+    return rows(predictColumns(model, [img], conf=conf, tile=True)[0])
+
+def predictColumns(model, imgs:list, conf:float=0.25, tile:bool=False, isolate:bool=False) -> list:
+    """
+    `predictBatch`, returning the detections of each image as columns (boxes, classes, scores; see detections.py).
+    This is what the servers run: the columns are built straight from the model output.
+    tile(bool, Default=False): run each image as overlapping full-resolution tiles (see tiling.py).
+    Images that cannot be decoded raise `imaging.UndecodableImage`.
+    isolate(bool, Default=False): return that exception (e.g. for a truncated upload) in place of the image's result
+        instead of raising it, so that the other images of the batch still get theirs.
+    """
+    from imaging import UndecodableImage, loadImage, restoreBoxes
+    from metrics import span
+    from registry import registry
+
+    model = registry.get(model)  # resident model (.pt or .onnx); only loaded on first use
+    if tile:
+        from tiling import detectTiled
+        results = []
+        for img in imgs:
+            with span("decode"):
+                im = loadImage(img)
+            results.append(detectTiled(model, im, conf=conf))
+        return results
+
+    # Encoded images are decoded at reduced resolution for the model's input size; boxes are mapped back below
+    with span("decode"):
+        ims = []
+        for img in imgs:
+            try:
+                im = loadImage(img, model.imgsz)
+            except UndecodableImage as e:
+                if not isolate:
+                    raise
+                im = e
+            ims.append(im)
+    decoded = [im for im in ims if not isinstance(im, Exception)]
+    results = iter(model.detect(decoded, conf=conf) if decoded else ())
+    with span("postprocess"):
+        return [im if isinstance(im, Exception) else restoreBoxes(next(results), im) for im in ims]
+
+def export(model:str=None, imgsz:int=640, project:str='detect', force:bool=False):
+    """
+    Export PyTorch weights to ONNX for serving through onnxruntime on CPU.
+    The ONNX file is written next to the weights, e.g. detect/<run>/weights/best.onnx.
+    model(str, Default=None): weights to export. If not given, export every detect/<run>/weights/best.pt.
+    force(bool, Default=False): re-export even if the ONNX file is newer than the weights.
+    """
+    from ultralytics import YOLO
+
+    if model is not None:
+        weights = [model]
+    else:
+        weights = [
+            os.path.join(project, name, "weights", "best.pt")
+            for name in sorted(os.listdir(project))
+            if os.path.exists(os.path.join(project, name, "weights", "best.pt"))
+        ]
+    for pt in weights:
+        pt = os.path.realpath(pt) # export next to the real weights, not next to `latest.pt`
+        onnx = os.path.splitext(pt)[0] + ".onnx"
+        if not force and os.path.exists(onnx) and os.path.getmtime(onnx) >= os.path.getmtime(pt):
+            print(f" [ {onnx} is up to date. ]")
+            continue
+        print(f" [ Exporting {pt} -> {onnx} ... ]")
+        # dynamic=True keeps the batch dimension free for batched serving
+        YOLO(pt).export(format="onnx", imgsz=imgsz, dynamic=True)
+        print(" [ Complete. ]\n")
+
+def exportSafetensors(model:str=None, project:str='detect', force:bool=False):
+    """
+    Export PyTorch weights, fused, to safetensors for memory-mapped serving (see backends.MmapBackend).
+    Worker processes serving the safetensors file share one copy of the weights in memory instead of holding one each.
+    The file is written next to the weights, e.g. detect/<run>/weights/best.safetensors, and can be served as `<model>:mmap`.
+    model(str, Default=None): weights to export. If not given, export every detect/<run>/weights/best.pt.
+    force(bool, Default=False): re-export even if the safetensors file is newer than the weights.
+    """
+    from backends import MmapBackend
+
+    if model is not None:
+        weights = [model]
+    else:
+        weights = [
+            os.path.join(project, name, "weights", "best.pt")
+            for name in sorted(os.listdir(project))
+            if os.path.exists(os.path.join(project, name, "weights", "best.pt"))
+        ]
+    for pt in weights:
+        pt = os.path.realpath(pt)
+        mapped = os.path.splitext(pt)[0] + ".safetensors"
+        if not force and os.path.exists(mapped) and os.path.getmtime(mapped) >= os.path.getmtime(pt):
+            print(f" [ {mapped} is up to date. ]")
+            continue
+        print(f" [ Exporting {pt} -> {mapped} ... ]")
+        MmapBackend.save(pt, mapped)
+        print(f" [ Complete: {os.path.getsize(mapped) / 1024**2:.1f} MB ]\n")
+
+def quantize(model:str="latest.pt", dataset:str=DEFAULT_DATASET, method:str="static", calibration:int=100, imgsz:int=640, report:bool=True):
+    """
+    Quantize a model to INT8 for CPU serving and compare it with the fp32 model.
+    The quantized model is written next to the weights as best.int8.onnx, and can be served as `<model>:int8` (see registry.resolveModel).
+    model(str, Default="latest.pt"): fp32 weights (.pt); exported to ONNX first if needed.
+    method(str, Default="static"): "static" calibrates activation ranges on images from `dataset`; "dynamic" quantizes weights only.
+    calibration(int, Default=100): number of calibration images, taken from the train split when the dataset is split.
+    report(bool, Default=True): measure mAP on the val split and p50/p95 latency of fp32 and INT8, saved as best.int8.json.
+    """
+    import onnx
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+    from imaging import letterbox, openImage
+
+    pt = os.path.realpath(model)
+    fp32 = os.path.splitext(pt)[0] + ".onnx"
+    int8 = os.path.splitext(pt)[0] + ".int8.onnx"
+    export(model=pt, imgsz=imgsz)
+
+    print(f" [ Quantizing {fp32} -> {int8} ({method}) ... ]")
+    if method == "dynamic":
+        quantize_dynamic(fp32, int8, weight_type=QuantType.QUInt8)
+    elif method == "static":
+        images = __splitImages(dataset, "train") or __splitImages(dataset)
+        if not images:
+            print(f"No labelled images found in {dataset}. Please run `python3 run.py buildNDJson` first.")
+            return
+        images = images[:calibration]
+        print(f" [ Calibrating on {len(images)} images from {dataset} ]")
+
+        class Calibration(CalibrationDataReader):
+            def __init__(self):
+                self.input = onnx.load(fp32, load_external_data=False).graph.input[0].name
+                self.images = iter(images)
+
+            def get_next(self):
+                img = next(self.images, None)
+                if img is None:
+                    return None
+                frame = letterbox(openImage(img), imgsz)[0]
+                return {self.input: frame.transpose(2, 0, 1)[None].astype("float32") / 255.0}
+
+        # The detection head mixes box coordinates (0..imgsz) and class scores (0..1) in one tensor;
+        # keep its decoding in fp32 so that INT8 scales only cover the convolutions.
+        graph = onnx.load(fp32, load_external_data=False).graph
+        head = max(int(node.name.split("/")[1].split(".")[1]) for node in graph.node if node.name.startswith("/model."))
+        exclude = [node.name for node in graph.node if node.name.startswith(f"/model.{head}/") and node.op_type != "Conv"]
+        quantize_static(
+            fp32, int8, Calibration(),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            nodes_to_exclude=exclude,
+        )
+    else:
+        print(f"Unknown method {method}: use 'static' or 'dynamic'.")
+        return
+    print(f" [ Complete: {os.path.getsize(fp32) / 1024**2:.1f} MB -> {os.path.getsize(int8) / 1024**2:.1f} MB ]\n")
+
+    if not report:
+        return
+
+    # === Accuracy (val split) and latency report ===
+    from ultralytics import YOLO
+    config_path = __dataConfig(dataset)
+    val_images = (__splitImages(dataset, "val") or __splitImages(dataset))[:100]
+    results = {"method": method, "calibration_images": calibration, "imgsz": imgsz, "models": {}}
+    for name, path in (("fp32 (torch)", pt), ("fp32 (onnx)", fp32), ("int8 (onnx)", int8)):
+        row = {"path": path, "size_mb": round(os.path.getsize(path) / 1024**2, 2)}
+        if config_path is not None:
+            metrics = YOLO(path, task="detect").val(data=config_path, split="val", imgsz=imgsz, batch=1, plots=False, verbose=False)
+            row["mAP50"] = round(float(metrics.box.map50), 4)
+            row["mAP50-95"] = round(float(metrics.box.map), 4)
+        if val_images:
+            row.update(__latency(path, val_images, imgsz=imgsz))
+        results["models"][name] = row
+
+    report_path = os.path.splitext(int8)[0] + ".json"
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"{'model':<14}{'size MB':>9}{'mAP50':>8}{'mAP50-95':>10}{'p50 ms':>9}{'p95 ms':>9}")
+    for name, row in results["models"].items():
+        print(f"{name:<14}{row['size_mb']:>9}{row.get('mAP50', '-'):>8}{row.get('mAP50-95', '-'):>10}{row.get('p50_ms', '-'):>9}{row.get('p95_ms', '-'):>9}")
+    print(f" [ Report saved to {report_path} ]")
+
+def benchmark(model:str="latest.pt", dataset:str=DEFAULT_DATASET, batch="1,8", imgsz="640", threads=None, backend="torch,onnx", limit:int=64, warmup:int=2):
+    """
+    Measure the serving performance of a model on the labelled images of a dataset (val split if there is one).
+    Every combination of the comma separated options is run in a fresh process:
+    batch(str, Default="1,8"): batch sizes.
+    imgsz(str, Default="640"): input sizes.
+    threads(str, Default=physical cores): torch / onnxruntime thread counts.
+    backend(str, Default="torch,onnx"): "torch" runs the .pt weights, "onnx" their ONNX export (exported first if needed).
+    limit(int, Default=64): number of images.
+    Reports images/sec, p50/p95/p99 latency per batch and peak memory. Images are decoded before timing.
+    The results are saved next to the weights as <name>.benchmark.<timestamp>.json, so that runs can be compared.
+    """
+    import time
+    import platform
+    import multiprocessing
+    from registry import modelPath, resolveModel
+    from workers import physicalCores
+
+    pt = resolveModel(model)
+    if pt is None:
+        print(f"Model {model} not found.")
+        return
+    pt = os.path.realpath(modelPath(pt))
+    images = (__splitImages(dataset, "val") or __splitImages(dataset))[:limit]
+    if not images:
+        print(f"No labelled images found in {dataset}. Please run `python3 run.py buildNDJson` first.")
+        return
+
+    paths = {}
+    for name in __values(backend, str):
+        if name == "torch":
+            paths[name] = pt
+        elif name == "onnx":
+            export(model=pt, imgsz=max(__values(imgsz)))
+            paths[name] = os.path.splitext(pt)[0] + ".onnx"
+        else:
+            print(f"Unknown backend {name}: use 'torch' or 'onnx'.")
+            return
+    configs = [
+        {"backend": name, "batch": b, "imgsz": size, "threads": t}
+        for name in paths
+        for b in __values(batch)
+        for size in __values(imgsz)
+        for t in __values(threads if threads is not None else physicalCores())
+    ]
+
+    import onnxruntime
+    import torch
+    results = {
+        "model": pt,
+        "dataset": dataset,
+        "images": len(images),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": {"platform": platform.platform(), "cpus": os.cpu_count(), "physical_cores": physicalCores()},
+        "versions": {"torch": torch.__version__, "onnxruntime": onnxruntime.__version__},
+        "runs": [],
+    }
+    context = multiprocessing.get_context("spawn")
+    for config in configs:
+        print(f" [ Benchmarking {config} ... ]")
+        with context.Pool(1) as worker:
+            row = worker.apply(__benchmarkRun, (paths[config["backend"]], images, config["batch"], config["imgsz"], config["threads"], warmup))
+        results["runs"].append({**config, **row})
+
+    report_path = f"{os.path.splitext(pt)[0]}.benchmark.{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"{'backend':<8}{'batch':>6}{'imgsz':>6}{'threads':>8}{'img/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'peak MB':>9}")
+    for row in results["runs"]:
+        print(f"{row['backend']:<8}{row['batch']:>6}{row['imgsz']:>6}{row['threads']:>8}{row['images_per_sec']:>9}{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}{row['peak_rss_mb']:>9}")
+    print(f" [ Report saved to {report_path} ]")
+
 def updateModel(categories:int=None, run:int=None, epoches:int=None, batch_size:int=None, model_name:str=None):
     """
     Update the model link, pointing to the latest model.
@@ -1,11 +1,15 @@
 from typing import Union
-import os, shutil
+import os, json, shutil
 
-from fastapi import FastAPI, status, File, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, status, File, Header, Request, Response, UploadFile, WebSocket
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
+from uploads import BodyLimit
+
 app = FastAPI(redoc_url=None, docs_url=None)
+# Reject oversized uploads while they arrive, before they are parsed (see uploads.py)
+app.add_middleware(BodyLimit)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://127.0.0.1:3000", "*"],
@@ -14,11 +18,81 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def preload():
+    """
+    Import everything, start the inference pool, and load and warm up the default model before the first request
+    arrives, on a background thread (see startup.py). Until it has finished, /ready answers 503.
+    """
+    from startup import startup
+    from workers import pool
+    pool.start()
+    startup.begin()
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness: 200 once startup has finished, 503 until then (or if it failed), with the startup phase timings.
+    """
+    from startup import startup
+    stats = startup.stats()
+    return JSONResponse(status_code=status.HTTP_200_OK if stats["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE, content=stats)
+
+@app.on_event("shutdown")
+def shutdown():
+    from pipeline import pipeline
+    from workers import pool
+    pipeline.shutdown()
+    pool.shutdown()
+
+@app.get("/metrics")
+async def prometheus():
+    """
+    Stage latency histograms, queue depths, resident models and cache counters in the Prometheus text format (see metrics.py).
+    """
+    import asyncio
+    from metrics import metrics
+    return PlainTextResponse(await asyncio.to_thread(metrics.render), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def stats():
+    """
+    Batching, inference pool, request pipeline, model registry, prediction cache, live stream, cascade, quality gate and dropped work metrics.
+    """
+    import asyncio
+    from batching import batcher
+    from cache import cache
+    from cascade import cascade
+    from deadlines import dropped
+    from live import streams
+    from pipeline import pipeline
+    from quality import gate
+    from workers import pool
+    # Process workers each have their own registry: asked for theirs off the event loop
+    models = await asyncio.to_thread(pool.modelStats)
+    return {"batching": batcher.stats(), "workers": pool.stats(), "pipeline": pipeline.stats(), "models": models, "cache": cache.stats(), "live": streams.stats(), "cascade": cascade.stats(), "quality": gate.stats(), "dropped": dropped.stats()}
+
 @app.post("/predict")
-def detect(img: UploadFile, model:str=None):
+async def detect(request: Request, img: UploadFile, model:str=None, tile:bool=False, accept:str=Header(default=None), deadline:str=Header(default=None, alias="X-Request-Deadline")):
     """
     Use a model `model` to do the object detection job.
     Default model: os.environ["DEFAULT_MODEL"]
+    `model` may also name a run in detect/ or a variant such as "int8" (see registry.resolveModel).
+    Concurrent requests for the same model are run as one batch (see batching.py);
+    an image already seen with the same model is answered from the cache (see cache.py).
+    Without `model`, cascade mode (os.environ["CASCADE_SMALL_MODEL"], see cascade.py) answers with a small model first;
+    the X-Model-Tier response header tells which tier answered.
+    tile=true detects on overlapping full-resolution tiles of the image (see tiling.py): slower, but finds small seedlings in large photos.
+    The upload is decoded in memory. Set os.environ["UPLOAD_DEBUG_DIR"] to write it to that folder first instead.
+    Uploads over os.environ["UPLOAD_MAX_BYTES"] (Default: 20 MiB) are rejected with 413 (see uploads.py).
+    Blurry, dark or tiny photos are answered with 422 without running the model (see quality.py):
+        {"error": "Please retake the photo.", "retake": true, "reasons": [{"check": "blur", "message": "...", ...}]}
+    Uploads that cannot be decoded as an image (unknown format, truncated file) are answered with 400.
+    Responds with one dict per box; clients that send `Accept: application/vnd.invastop.columnar+json`
+    or `Accept: application/msgpack` get compact columns instead (see detections.py).
+    The backend proxy sends `X-Request-Deadline`, the Unix time after which it no longer waits (see deadlines.py):
+    once it passes before the image runs, the request is answered 504 instead; once it passes, or the client
+    disconnects, while the image runs, the response is not encoded.
 
     TODO: Only allow requests from main server IP, listed in os.environ["WHITELIST"]
     """
@@ -28,22 +102,171 @@ def detect(img: UploadFile, model:str=None):
     # TODO: Add rate control
 
     # Check if the model exists
+    from registry import resolveModel
+    requested = model
+    model = resolveModel(model, default=os.environ.get("DEFAULT_MODEL"))
     if model is None:
-        model = os.environ.get("DEFAULT_MODEL")
-    print(f"model={model}")
-    if (model is None) or (not os.path.exists(model)):
         payload["error"] = "Model is not available."
         return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content=payload)
+    # Requests for the default model go through the small model first in cascade mode
+    from cascade import cascade
+    tiers = cascade.models(model) if cascade.enabled and requested is None and not tile else None
+
+    # Do the detection, decoding the upload in memory
+    from batching import batcher
+    from deadlines import DeadlineExceeded, dropped, parse
+    from imaging import UndecodableImage
+    from metrics import Timings
+    from quality import RetakePhoto
+    from workers import Busy
+    deadline = parse(deadline)
+    timings = Timings()
+    from uploads import UploadTooLarge, readUpload
+    try:
+        with timings.span("read"):
+            data = await readUpload(img)
+    except UploadTooLarge as e:
+        payload["error"] = str(e)
+        return JSONResponse(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, content=payload)
+    debug_dir = os.environ.get("UPLOAD_DEBUG_DIR")
+    if debug_dir:
+        # Debugging only: go through a file on disk as the old path did
+        from imaging import saveUpload
+        image = saveUpload(data, img.filename, debug_dir)
+    else:
+        image = data
+    tier = None
+    try:
+        if tiers is not None:
+            payload, tier = await cascade.submit(*tiers, image, timings=timings, deadline=deadline)
+        else:
+            payload = await batcher.submit(model, image, tile=tile, timings=timings, deadline=deadline)
+    except Busy as e:
+        # Reject straight away rather than queueing behind a backlog
+        payload["error"] = "Server is busy, please try again later."
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content=payload, headers={"Retry-After": str(e.retry_after)})
+    except RetakePhoto as e:
+        # Blurry, dark or tiny: answered without running the model (see quality.py)
+        return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content=e.response())
+    except UndecodableImage as e:
+        # Not an image, or a truncated one: reported as /predict/batch and /ws/predict report it for one image
+        payload["error"] = str(e)
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=payload)
+    except DeadlineExceeded as e:
+        # The proxy has already given up on this request (see deadlines.py)
+        payload["error"] = str(e)
+        return JSONResponse(status_code=status.HTTP_504_GATEWAY_TIMEOUT, content=payload)
+    finally:
+        if debug_dir:
+            os.remove(image)
+
+    # Nobody is waiting for the response any more: do not encode it
+    reason = await dropped.abandoned(request, deadline)
+    if reason == "deadline":
+        payload = {"error": "The request deadline passed while it was running."}
+        return JSONResponse(status_code=status.HTTP_504_GATEWAY_TIMEOUT, content=payload)
+    if reason == "disconnected":
+        return Response(status_code=499) # Client Closed Request, for the access log
+
+    from detections import negotiate, render
+    media_type = negotiate(accept)
+    from pipeline import pipeline
+    if pipeline.enabled:
+        body = await pipeline.serialize(payload, media_type, timings)
+    else:
+        with timings.span("serialize"):
+            body = render(payload, media_type)
+    response = Response(content=body, status_code=status.HTTP_200_OK, media_type=media_type)
+    response.headers["Vary"] = "Accept"
+    response.headers["Server-Timing"] = timings.header()
+    if tier is not None:
+        response.headers["X-Model-Tier"] = tier
+    timings.finish("predict")
+    return response
 
-    # Do the detection
-    from run import predict
-    with open(img.filename, "wb") as f:
-        f.write(img.file.read())
-    print(f"Start predicting: <{img.filename}> with model [{model}].")
-    payload = predict(model=model, img=img.filename, visualize=False)
-    os.remove(img.filename)
+@app.post("/predict/batch")
+async def detectBatch(imgs: list[UploadFile], model:str=None, accept:str=Header(default=None)):
+    """
+    Run many images through the model `model` and stream the results back.
+    imgs: the images, as repeated multipart fields and/or zip archives of images.
+    Responds with NDJSON, one line per image in the order they finish:
+        {"index": 0, "file": "a.jpg", "detections": [...]} or {"index": 0, "file": "a.jpg", "error": "..."}
+    Images failing the quality gate get "retake": true and "reasons" next to "error" (see /predict).
+    `index` is the position of the image in the upload (zip members in archive order).
+    With a compact Accept header (see /predict), "detections" holds columns instead of one dict per box.
+    At most os.environ["BATCH_MAX_IMAGES"] (Default: 200) images are accepted per request, each of at most
+    os.environ["UPLOAD_MAX_BYTES"] and all together at most os.environ["BATCH_MAX_BYTES"] (see uploads.py).
+    Corrupt zip archives are answered with 400.
+    """
+    payload = {} # JSON response payload
+
+    # Check if the model exists
+    from registry import resolveModel
+    model = resolveModel(model, default=os.environ.get("DEFAULT_MODEL"))
+    if model is None:
+        payload["error"] = "Model is not available."
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content=payload)
+
+    # Collect the images, unpacking zip archives in memory
+    import asyncio, zipfile
+    from batching import batcher
+    from imaging import isZip, unzipImages
+    from uploads import BATCH_MAX_BYTES, UploadTooLarge, readUpload
+    max_images = int(os.environ.get("BATCH_MAX_IMAGES", 200))
+    images = []
+    size = 0 # bytes of the images so far, decompressed
+    for upload in imgs:
+        try:
+            data = await readUpload(upload)
+            if isZip(data):
+                # Bounded by what they decompress to, not by the size of the archive; decompressed off the event loop
+                members = await asyncio.to_thread(unzipImages, data, limit=max_images + 1 - len(images), max_total=BATCH_MAX_BYTES - size)
+            else:
+                members = [(upload.filename, data)]
+        except UploadTooLarge as e:
+            payload["error"] = f"{upload.filename}: {e}"
+            return JSONResponse(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, content=payload)
+        except (zipfile.BadZipFile, zipfile.LargeZipFile) as e:
+            payload["error"] = f"{upload.filename}: not a valid zip archive ({e})."
+            return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=payload)
+        images.extend(members)
+        size += sum(len(image) for _, image in members)
+        if len(images) > max_images:
+            payload["error"] = f"Too many images: at most {max_images} per request."
+            return JSONResponse(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, content=payload)
+    print(f"Start predicting: {len(images)} images with model [{model}].")
+
+    from detections import JSON, negotiate, rows
+    columnar = negotiate(accept) != JSON
+
+    async def lines():
+        async for line in batcher.stream(model, images):
+            if "detections" in line and not columnar:
+                line["detections"] = rows(line["detections"])
+            yield json.dumps(line) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.websocket("/ws/predict")
+async def detectLive(websocket: WebSocket, model:str=None, conf:float=0.25):
+    """
+    Live detection on a stream of JPEG frames from a camera (see live.py).
+    Send each frame as a binary message; every processed frame is answered with
+        {"seq": 12, "detections": [...], "dropped": 3, "latency_ms": 41.2}
+    When inference falls behind, stale frames are dropped so that only the newest one is processed.
+    `model` works as for /predict; conf is the confidence threshold.
+    """
+    from registry import resolveModel
+    await websocket.accept()
+    model = resolveModel(model, default=os.environ.get("DEFAULT_MODEL"))
+    if model is None:
+        await websocket.send_json({"error": "Model is not available."})
+        await websocket.close(code=1008)
+        return
 
-    return JSONResponse(status_code=status.HTTP_200_OK, content=payload)
+    from live import streams
+    print(f"Start live predicting with model [{model}].")
+    await streams.serve(websocket, model, conf)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,149 @@
+"""
+Server startup, so that the first request does not pay for it.
+
+Run in phases, each timed and logged:
+    imports   numpy, PIL, torch and Ultralytics or onnxruntime (for thread workers), and the inference modules
+    pool      the inference pool; process workers import, load and fuse the default model themselves
+    cache     pruning expired entries of the prediction cache
+    model     loading and fusing the default model (in this process for thread workers);
+              traced and cached on disk with MODEL_TRACE_CACHE=1 (see backends.TorchBackend)
+    warmup    one full batch of encoded images through the whole inference path on every worker
+    watch     watching the served model files for new weights (see registry.watch)
+Startup runs on a background thread so that the server accepts connections at once; /ready answers 503
+until every phase has finished, then 200 with the phase timings.
+
+Settings (environment variables):
+    WARMUP_BATCH(int, Default: BATCH_MAX_SIZE or 8): images in the warm-up batch; 0 skips it.
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+def _warmup(model:str, size:int) -> float:
+    """
+    Run a batch of `size` blank JPEG images through `run.predictColumns` on a worker; returns the seconds it took.
+    """
+    import io
+    from PIL import Image
+    from run import predictColumns
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (640, 480)).save(buffer, format="JPEG")
+    start = time.perf_counter()
+    predictColumns(model, [buffer.getvalue()] * size)
+    return time.perf_counter() - start
+
+class Startup:
+    def __init__(self, warmup_batch:int=None):
+        if warmup_batch is None:
+            warmup_batch = int(os.environ.get("WARMUP_BATCH", os.environ.get("BATCH_MAX_SIZE", 8)))
+        self.warmup_batch = warmup_batch
+        self.phases = {} # phase -> seconds, in the order they ran
+        self.phase = None # the phase running now
+        self.error = None
+        self.start = None
+        self._done = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set() and self.error is None
+
+    def begin(self, model:str=None):
+        """
+        Start up on a background thread; `model` (Default: os.environ["DEFAULT_MODEL"], anything registry.resolveModel accepts)
+        is loaded and warmed up.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.run, args=(model,), name="startup", daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout:float=None) -> bool:
+        """
+        Block until startup has finished; returns whether the server is ready.
+        """
+        self._done.wait(timeout)
+        return self.ready
+
+    def run(self, model:str=None):
+        """
+        Run every phase in this thread.
+        """
+        from registry import resolveModel
+        requested = model or os.environ.get("DEFAULT_MODEL")
+        model = resolveModel(requested)
+        if model is None:
+            print(f" [ Default model {requested} is not available; models will be loaded on first use. ]")
+        self.start = time.perf_counter()
+        try:
+            self._run(model)
+        except Exception as e:
+            self.error = f"{self.phase}: {e}"
+            print(f" [ Startup failed in phase {self.phase}: {e} ]")
+        else:
+            print(f" [ Ready in {time.perf_counter() - self.start:.2f}s: " + ", ".join(f"{k} {v:.2f}s" for k, v in self.phases.items()) + " ]")
+        finally:
+            self.phase = None
+            self._done.set()
+
+    def _run(self, model:str):
+        from registry import modelPath
+        from workers import pool
+        path = modelPath(model) if model is not None else None
+        with self._phase("imports"):
+            import numpy
+            import PIL.Image
+            # Process workers import the inference framework themselves
+            if pool.kind == "thread" and (path is None or not path.endswith(".onnx")):
+                import torch
+                import ultralytics
+            if pool.kind == "thread" and (path is None or path.endswith(".onnx")):
+                import onnxruntime
+            import backends
+            import batching
+            import imaging
+            import run
+
+        with self._phase("pool"):
+            pool.ready()
+
+        from cache import cache
+        with self._phase("cache"):
+            if cache.prune():
+                print(" [ Removed expired entries from the prediction cache. ]")
+
+        from registry import registry
+        if model is not None:
+            if pool.kind == "thread":
+                with self._phase("model"):
+                    registry.preload(model)
+            if self.warmup_batch > 0:
+                with self._phase("warmup"):
+                    pool.broadcast(_warmup, model, self.warmup_batch)
+
+        if pool.kind == "thread":
+            # Swap in new weights as soon as e.g. latest.pt is re-pointed; process workers watch for themselves
+            with self._phase("watch"):
+                registry.watch()
+
+    @contextmanager
+    def _phase(self, name:str):
+        self.phase = name
+        start = time.perf_counter()
+        yield
+        self.phases[name] = time.perf_counter() - start
+        print(f" [ Startup: {name} took {self.phases[name]:.2f}s ]")
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "phase": self.phase,
+            "error": self.error,
+            "phases_ms": {name: round(seconds * 1000, 2) for name, seconds in self.phases.items()},
+            "total_ms": round(sum(self.phases.values()) * 1000, 2),
+        }
+
+# The startup of this process
+startup = Startup()
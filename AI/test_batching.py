@@ -0,0 +1,83 @@
+"""
+Tests of the micro-batcher, with a stand-in for the model.
+
+Run from this folder: python -m pytest test_batching.py
+"""
+import time
+import asyncio
+
+import pytest
+
+from batching import MicroBatcher
+
+class CountingModel:
+    """
+    A `run_batch` that records the images it runs, each batch taking `delay` seconds.
+    """
+    def __init__(self, delay:float=0.2):
+        self.delay = delay
+        self.images = []
+
+    def __call__(self, model:str, images:list, conf:float) -> list:
+        time.sleep(self.delay)
+        self.images.extend(images)
+        return [{"boxes": [], "classes": [], "scores": [], "names": {}} for _ in images]
+
+@pytest.fixture
+def model(tmp_path) -> str:
+    path = tmp_path / "model.pt"
+    path.write_text("weights")
+    return str(path)
+
+def test_identical_submits_run_once(model):
+    run = CountingModel()
+    batcher = MicroBatcher(run_batch=run, wait_ms=0)
+
+    async def main():
+        return await asyncio.gather(*(batcher.submit(model, b"photo", screen=False) for _ in range(2)))
+
+    first, second = asyncio.run(main())
+    assert first == second
+    assert run.images == [b"photo"]
+    assert batcher.deduplicated == 1
+
+def test_cancelled_waiter_does_not_cancel_the_other(model):
+    run = CountingModel()
+    batcher = MicroBatcher(run_batch=run, wait_ms=0)
+
+    async def main():
+        first = asyncio.ensure_future(batcher.submit(model, b"photo", screen=False))
+        second = asyncio.ensure_future(batcher.submit(model, b"photo", screen=False))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        return await second, first.cancelled()
+
+    result, cancelled = asyncio.run(main())
+    assert cancelled
+    assert result["boxes"] == []
+    assert run.images == [b"photo"]
+
+def test_image_nobody_waits_for_is_not_run(model):
+    run = CountingModel()
+    batcher = MicroBatcher(run_batch=run, wait_ms=200)
+
+    async def main():
+        waiters = [asyncio.ensure_future(batcher.submit(model, b"photo", screen=False)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.sleep(0.3)
+
+    asyncio.run(main())
+    assert run.images == []
+
+def test_different_images_are_run_in_one_batch(model):
+    run = CountingModel(delay=0)
+    batcher = MicroBatcher(run_batch=run, wait_ms=50)
+
+    async def main():
+        return await asyncio.gather(*(batcher.submit(model, bytes([i]), screen=False) for i in range(3)))
+
+    assert len(asyncio.run(main())) == 3
+    assert sorted(run.images) == [b"\x00", b"\x01", b"\x02"]
+    assert batcher.batches == 1
@@ -0,0 +1,83 @@
+"""
+Tests of the prediction cache.
+
+Run from this folder: python -m pytest test_cache.py
+"""
+import os
+import time
+import asyncio
+
+import pytest
+
+import cache
+from cache import PredictionCache
+
+value = {"boxes": [[0.1, 0.2, 0.3, 0.4]], "classes": [0], "scores": [0.9], "names": {"0": "plant"}}
+
+@pytest.fixture
+def model(tmp_path) -> str:
+    path = tmp_path / "model.pt"
+    path.write_text("weights")
+    return str(path)
+
+def test_hit_and_miss(model):
+    store = PredictionCache(max_entries=8, ttl=60, folder="")
+    key = store.key(b"photo", model, 0.25)
+    assert store.get(key) is None
+    store.put(key, value)
+    assert store.get(key) == value
+    assert store.get(store.key(b"other photo", model, 0.25)) is None
+    assert (store.hits, store.misses) == (1, 2)
+
+def test_least_recently_used_entry_is_evicted(model):
+    store = PredictionCache(max_entries=2, ttl=60, folder="")
+    a, b, c = (store.key(data, model, 0.25) for data in (b"a", b"b", b"c"))
+    store.put(a, value)
+    store.put(b, value)
+    store.get(a)
+    store.put(c, value)
+    assert store.get(b) is None
+    assert store.get(a) == value and store.get(c) == value
+
+def test_entry_expires_after_ttl(model):
+    store = PredictionCache(max_entries=8, ttl=0.05, folder="")
+    key = store.key(b"photo", model, 0.25)
+    store.put(key, value)
+    assert store.get(key) == value
+    time.sleep(0.1)
+    assert store.get(key) is None
+    assert store.stats()["entries"] == 0
+
+def test_key_covers_model_settings_and_format(model, monkeypatch):
+    key = PredictionCache.key(b"photo", model, 0.25)
+    assert PredictionCache.key(b"photo", model, 0.5) != key
+    assert PredictionCache.key(b"photo", model, 0.25, variant="tiled") != key
+    # Entries written in an older format are never read back
+    monkeypatch.setattr(cache, "FORMAT", cache.FORMAT + 1)
+    assert PredictionCache.key(b"photo", model, 0.25) != key
+    monkeypatch.undo()
+    # Nor are the results of the weights before a retrain
+    stat = os.stat(model)
+    os.utime(model, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert PredictionCache.key(b"photo", model, 0.25) != key
+
+def test_disk_store_survives_restart(model, tmp_path):
+    folder = str(tmp_path / "cache")
+    store = PredictionCache(max_entries=8, ttl=60, folder=folder)
+    key = store.key(b"photo", model, 0.25)
+    store.put(key, value)
+    store._io().submit(lambda: None).result() # wait for the write behind put
+
+    restarted = PredictionCache(max_entries=8, ttl=60, folder=folder)
+    assert asyncio.run(restarted.lookup(key)) == value
+    assert restarted.disk_hits == 1
+    # Now in memory as well
+    assert restarted.get(key) == value
+    assert restarted.hits == 1
+
+def test_prune_removes_expired_entries_from_disk(model, tmp_path):
+    store = PredictionCache(max_entries=8, ttl=0.05, folder=str(tmp_path / "cache"))
+    store.put(store.key(b"photo", model, 0.25), value)
+    store._io().submit(lambda: None).result()
+    time.sleep(0.1)
+    assert store.prune() == 1
@@ -0,0 +1,101 @@
+"""
+Tests of request deadlines, with a stand-in for the model.
+
+Run from this folder: python -m pytest test_deadlines.py
+"""
+import time
+import asyncio
+
+import pytest
+
+import deadlines
+from batching import MicroBatcher
+from deadlines import DeadlineExceeded
+
+class CountingModel:
+    """
+    A `run_batch` that records the images it runs, each batch taking `delay` seconds.
+    """
+    def __init__(self, delay:float=0):
+        self.delay = delay
+        self.images = []
+
+    def __call__(self, model:str, images:list, conf:float) -> list:
+        time.sleep(self.delay)
+        self.images.extend(images)
+        return [{"boxes": [], "classes": [], "scores": [], "names": {}} for _ in images]
+
+@pytest.fixture
+def model(tmp_path) -> str:
+    path = tmp_path / "model.pt"
+    path.write_text("weights")
+    return str(path)
+
+@pytest.fixture
+def dropped(monkeypatch):
+    """
+    A fresh count of dropped work, in place of the one of this process.
+    """
+    fresh = deadlines.DroppedWork()
+    monkeypatch.setattr(deadlines, "dropped", fresh)
+    import batching
+    monkeypatch.setattr(batching, "dropped", fresh)
+    return fresh
+
+def test_header_values():
+    assert deadlines.parse("1760700000.25") == 1760700000.25
+    assert deadlines.parse(None) is None
+    assert deadlines.parse("soon") is None
+    assert deadlines.expired(100, now=100)
+    assert not deadlines.expired(None, now=100)
+    assert deadlines.latest(1, 2) == 2
+    assert deadlines.latest(1, None) is None
+
+def test_expired_deadline_answers_504_before_the_image_runs(model, monkeypatch, dropped):
+    from fastapi.testclient import TestClient
+    import server
+    from batching import batcher
+    run = CountingModel()
+    monkeypatch.setattr(batcher, "run_batch", run)
+    monkeypatch.setenv("DEFAULT_MODEL", model)
+    # Without `with`, so that startup does not load the model
+    client = TestClient(server.app)
+
+    response = client.post("/predict", files={"img": ("photo.jpg", b"photo")}, headers={deadlines.HEADER: str(time.time() - 1)})
+    assert response.status_code == 504
+    assert run.images == []
+    assert dropped.counts["queue", "deadline"] == 1
+
+def test_deadline_passing_in_the_queue_drops_the_image(model, dropped):
+    run = CountingModel(delay=0.3)
+    batcher = MicroBatcher(run_batch=run, wait_ms=0)
+
+    async def main():
+        # The first image holds the pool while the second one's deadline passes
+        first = asyncio.ensure_future(batcher.submit(model, b"first", screen=False))
+        await asyncio.sleep(0.05)
+        with pytest.raises(DeadlineExceeded):
+            await batcher.submit(model, b"second", screen=False, deadline=time.time() + 0.1)
+        await first
+
+    asyncio.run(main())
+    assert run.images == [b"first"]
+    assert dropped.counts["queue", "deadline"] == 1
+
+def test_shared_run_waits_for_the_latest_deadline(model, dropped):
+    run = CountingModel(delay=0.3)
+    batcher = MicroBatcher(run_batch=run, wait_ms=0)
+
+    async def main():
+        first = asyncio.ensure_future(batcher.submit(model, b"first", screen=False))
+        await asyncio.sleep(0.05)
+        # Identical uploads: only one of them has given up by the time the pool is free
+        return await asyncio.gather(
+            batcher.submit(model, b"second", screen=False, deadline=time.time() + 0.1),
+            batcher.submit(model, b"second", screen=False, deadline=time.time() + 5),
+            first, return_exceptions=True)
+
+    soon, later, _ = asyncio.run(main())
+    assert soon == later
+    assert run.images == [b"first", b"second"]
+    assert dropped.counts["queue", "deadline"] == 0
@@ -0,0 +1,82 @@
+"""
+Tests of the detection response formats and of the non-maximum suppression of the ONNX backend.
+
+Run from this folder: python -m pytest test_detections.py
+"""
+import json
+
+import numpy as np
+import pytest
+
+from backends import nms
+from detections import COLUMNAR_JSON, JSON, MSGPACK, columns, negotiate, render, rows, scale
+
+names = {0: "lantana", 1: "parthenium", 2: "prickly acacia"}
+
+# x1, y1, x2, y2, confidence, class
+predictions = np.array([
+    [12.345678, 20.5, 110.25, 205.123456, 0.912345678, 0],
+    [300.0, 40.0, 420.5, 160.75, 0.5, 2],
+    [5.0, 6.0, 7.0, 8.0, 0.25, 0],
+], dtype=np.float32)
+
+def detections() -> dict:
+    return columns(predictions[:, :4], predictions[:, 5], predictions[:, 4], names)
+
+def msgpack() -> bool:
+    try:
+        import msgpack
+    except ImportError:
+        return False
+    return True
+
+def test_rows_match_results_to_json():
+    torch = pytest.importorskip("torch")
+    results = pytest.importorskip("ultralytics.engine.results")
+    expected = results.Results(np.zeros((480, 640, 3), np.uint8), path="photo.jpg", names=names, boxes=torch.from_numpy(predictions)).to_json()
+    assert rows(detections()) == json.loads(expected)
+
+def test_columns_list_only_classes_present():
+    assert detections()["names"] == {"0": "lantana", "2": "prickly acacia"}
+    assert detections()["classes"] == [0, 2, 0]
+
+def test_scale():
+    assert scale(detections(), 2, 0.5)["boxes"][1] == [600.0, 20.0, 841.0, 80.375]
+
+def test_negotiate():
+    assert negotiate(None) == JSON
+    assert negotiate("text/html, */*") == JSON
+    assert negotiate(f"{COLUMNAR_JSON};q=0.9, {JSON}") == COLUMNAR_JSON
+    assert negotiate("application/x-msgpack") == (MSGPACK if msgpack() else JSON)
+
+def test_render():
+    assert json.loads(render(detections())) == rows(detections())
+    assert json.loads(render(detections(), COLUMNAR_JSON)) == detections()
+
+def test_render_msgpack():
+    if not msgpack():
+        pytest.skip("msgpack is not installed")
+    import msgpack as packer
+    unpacked = packer.unpackb(render(detections(), MSGPACK), strict_map_key=False)
+    assert unpacked["classes"] == [0, 2, 0]
+    assert unpacked["boxes"][0] == pytest.approx(detections()["boxes"][0])
+
+def test_nms_keeps_overlapping_boxes_of_other_classes():
+    boxes = np.array([[0, 0, 100, 100], [5, 5, 105, 105], [5, 5, 105, 105]], dtype=np.float32)
+    scores = np.array([0.9, 0.8, 0.7], dtype=np.float32)
+    classes = np.array([0, 0, 1])
+    assert nms(boxes, scores, classes).tolist() == [0, 2]
+
+def test_nms_keeps_highest_score_first():
+    boxes = np.array([[0, 0, 10, 10], [50, 50, 60, 60], [1, 1, 10, 10]], dtype=np.float32)
+    scores = np.array([0.3, 0.9, 0.6], dtype=np.float32)
+    assert nms(boxes, scores, np.zeros(3)).tolist() == [1, 2]
+    assert nms(np.zeros((0, 4), np.float32), np.zeros(0), np.zeros(0)).tolist() == []
+
+def test_nms_smaller_suppresses_nested_boxes():
+    # The second box lies inside the first: IoU 0.25, but all of it overlaps
+    boxes = np.array([[0, 0, 100, 100], [10, 10, 60, 60]], dtype=np.float32)
+    scores = np.array([0.9, 0.8], dtype=np.float32)
+    classes = np.zeros(2)
+    assert nms(boxes, scores, classes, iou=0.5).tolist() == [0, 1]
+    assert nms(boxes, scores, classes, iou=0.5, smaller=True).tolist() == [0]
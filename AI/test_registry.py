@@ -0,0 +1,135 @@
+"""
+Tests of the model registry, with stand-in backends instead of real weights.
+
+Run from this folder: python -m pytest test_registry.py
+"""
+import os
+import time
+import threading
+
+import pytest
+
+import backends
+from registry import ModelRegistry, resolveModel
+
+class FakeBackend:
+    kind = "fake"
+    nbytes = 1
+    names = {0: "plant"}
+    imgsz = 640
+
+    def __init__(self, path:str):
+        self.path = path
+
+    def detect(self, images:list, conf:float=0.25, imgsz:int=None) -> list:
+        return [[] for _ in images]
+
+loads = [] # paths loaded by fakeLoad
+
+def fakeLoad(path:str):
+    content = open(path).read()
+    if content == "corrupt":
+        raise ValueError(f"{path} is not a model")
+    if content == "slow":
+        time.sleep(0.5)
+    loads.append(path)
+    return FakeBackend(path)
+
+@pytest.fixture
+def weights(tmp_path, monkeypatch):
+    """
+    Writes a weights file in tmp_path and returns its path; "corrupt" ones fail to load.
+    """
+    monkeypatch.setattr(backends, "load", fakeLoad)
+
+    def write(name:str, content:str="weights") -> str:
+        path = tmp_path / name
+        path.write_text(content)
+        return str(path)
+    return write
+
+def repoint(link:str, target:str):
+    os.remove(link)
+    os.symlink(target, link)
+
+def waitFor(condition, timeout:float=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_failed_swap_keeps_serving_old_model(weights, tmp_path):
+    registry = ModelRegistry(warmup=False, watch_interval=0)
+    good = weights("good.pt")
+    link = str(tmp_path / "latest.pt")
+    os.symlink(good, link)
+    old = registry.get(link)
+    assert old.backend.path == os.path.realpath(good)
+
+    repoint(link, weights("corrupt.pt", "corrupt"))
+    assert registry.get(link) is old
+    waitFor(lambda: registry._failed)
+    # The swap has failed: the old model keeps serving instead of every request raising
+    for _ in range(3):
+        assert registry.get(link) is old
+    assert registry.swaps == 0
+
+def test_swap_switches_over_once_loaded(weights, tmp_path):
+    registry = ModelRegistry(warmup=False, watch_interval=0)
+    link = str(tmp_path / "latest.pt")
+    os.symlink(weights("a.pt"), link)
+    old = registry.get(link)
+
+    new = weights("b.pt")
+    repoint(link, new)
+    assert registry.get(link) is old
+    waitFor(lambda: registry.swaps == 1)
+    assert registry.get(link).backend.path == os.path.realpath(new)
+
+def test_cold_load_does_not_block_resident_models(weights):
+    registry = ModelRegistry(warmup=False, watch_interval=0)
+    resident = weights("default.pt")
+    registry.get(resident)
+    cold = weights("int8.pt", "slow")
+    del loads[:]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get(cold))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    start = time.perf_counter()
+    registry.get(resident)
+    assert time.perf_counter() - start < 0.1
+    for thread in threads:
+        thread.join()
+    # The callers for the cold model waited for one load
+    assert loads == [os.path.realpath(cold)]
+    assert len({id(loaded) for loaded in results}) == 1
+
+def test_failed_cold_load_raises_for_every_caller(weights):
+    registry = ModelRegistry(warmup=False, watch_interval=0)
+    corrupt = weights("corrupt.pt", "corrupt")
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            registry.get(corrupt)
+
+def test_variant_follows_link_to_new_weights(weights, tmp_path):
+    registry = ModelRegistry(warmup=False, watch_interval=0)
+    for run in ("run1", "run2"):
+        (tmp_path / run).mkdir()
+        weights(f"{run}/best.pt")
+        weights(f"{run}/best.safetensors")
+    link = str(tmp_path / "latest.pt")
+    os.symlink(str(tmp_path / "run1" / "best.pt"), link)
+
+    name = resolveModel(f"{link}:mmap")
+    assert name == f"{link}:mmap"
+    old = registry.get(name)
+    assert old.backend.path == os.path.realpath(tmp_path / "run1" / "best.safetensors")
+
+    # Re-pointing the link swaps the variant in the background, as it does for the link itself
+    repoint(link, str(tmp_path / "run2" / "best.pt"))
+    assert registry.get(name) is old
+    waitFor(lambda: registry.swaps == 1)
+    assert registry.get(name).backend.path == os.path.realpath(tmp_path / "run2" / "best.safetensors")
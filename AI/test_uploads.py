@@ -0,0 +1,82 @@
+"""
+Tests of the upload size limits.
+
+Run from this folder: python -m pytest test_uploads.py
+"""
+import io
+import json
+import asyncio
+
+import pytest
+
+from uploads import BodyLimit, UploadTooLarge, readUpload
+
+class EchoApp:
+    """
+    An ASGI app answering the size of the body it read, counting the requests that reach it.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self, scope, receive, send):
+        self.calls += 1
+        size = 0
+        while True:
+            message = await receive()
+            size += len(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": str(size).encode()})
+
+def call(app, path:str, chunks:list, headers:list=()) -> list:
+    """
+    Send a request with its body in `chunks` straight to an ASGI `app`; returns the messages it sent back.
+    """
+    scope = {"type": "http", "method": "POST", "path": path, "headers": list(headers)}
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1} for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent
+
+def test_declared_length_over_limit_is_rejected_before_the_app():
+    from fastapi.testclient import TestClient
+    echo = EchoApp()
+    client = TestClient(BodyLimit(echo, limits={"/predict": 100}))
+
+    response = client.post("/predict", content=b"x" * 101)
+    assert response.status_code == 413
+    assert "100 bytes" in response.json()["error"]
+    assert echo.calls == 0
+
+    assert client.post("/predict", content=b"x" * 100).text == "100"
+    # Other paths are not limited
+    assert client.post("/stats", content=b"x" * 1000).text == "1000"
+
+def test_counted_body_over_limit_is_rejected():
+    echo = EchoApp()
+    # No Content-Length, e.g. a chunked upload: the body is counted as it arrives
+    sent = call(BodyLimit(echo, limits={"/predict": 100}), "/predict", [b"x" * 60, b"x" * 60])
+    assert sent[0]["status"] == 413
+    assert "100 bytes" in json.loads(sent[1]["body"])["error"]
+    assert echo.calls == 1
+
+def test_understated_length_is_counted():
+    sent = call(BodyLimit(EchoApp(), limits={"/predict": 100}), "/predict", [b"x" * 60, b"x" * 60], headers=[(b"content-length", b"10")])
+    assert [message.get("status") for message in sent if message["type"] == "http.response.start"] == [413]
+
+def test_read_upload_stops_at_the_limit():
+    from starlette.datastructures import UploadFile
+    assert asyncio.run(readUpload(UploadFile(io.BytesIO(b"x" * 100)), limit=100, chunk=30)) == b"x" * 100
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(readUpload(UploadFile(io.BytesIO(b"x" * 101)), limit=100, chunk=30))
+    # A declared size over the limit is rejected without reading
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(readUpload(UploadFile(io.BytesIO(b""), size=101), limit=100))
@@ -0,0 +1,88 @@
+"""
+Tiled inference for high-resolution photos.
+
+Downscaling a 12 MP field photo to 640 px shrinks a seedling to a few pixels. In tiled
+mode the photo is cut into overlapping tiles of the model's input size, so they are
+seen at full resolution. All tiles of one photo, plus the whole photo downscaled as
+usual to keep large plants in one piece, run as a single batch. Boxes are then shifted
+back into photo coordinates and merged across tiles with class-aware NMS. Overlap is
+measured over the smaller box, so that the part of a plant cut by a tile edge is merged
+into the whole plant seen by the next tile.
+
+Tiling costs about one forward pass per tile: see `python bench.py tiles` for the cost
+per megapixel against plain inference.
+
+Settings (environment variables):
+    TILE_SIZE(int, Default: the model's input size): tile width and height, in photo pixels.
+    TILE_OVERLAP(float, Default: 0.2): fraction of a tile shared with its neighbour.
+    TILE_IOU(float, Default: 0.5): overlap above which boxes of the same class are merged.
+    TILE_FULL(bool, Default: 1): also run the whole downscaled photo in the same batch.
+"""
+import os
+import math
+
+def grid(w:int, h:int, size:int, overlap:float=0.2) -> list:
+    """
+    Overlapping size x size tiles covering a w x h image, as (x1, y1, x2, y2).
+    The last row and column are aligned with the image border, so every tile has the same shape.
+    """
+    def starts(length:int) -> list:
+        if length <= size:
+            return [0]
+        step = max(1, int(size * (1 - overlap)))
+        n = math.ceil((length - size) / step) + 1
+        return sorted({min(i * step, length - size) for i in range(n)})
+
+    tw, th = min(size, w), min(size, h)
+    return [(x, y, x + tw, y + th) for y in starts(h) for x in starts(w)]
+
+def detectTiled(loaded, im, conf:float=0.25, size:int=None, overlap:float=None, iou:float=None, full:bool=None) -> dict:
+    """
+    Detect on overlapping tiles of a PIL image with a `registry.LoadedModel` and merge the boxes.
+    Returns detection columns as `LoadedModel.detect` does (see detections.py), in image pixels.
+    """
+    from metrics import span
+
+    size = size or int(os.environ.get("TILE_SIZE", 0)) or loaded.imgsz
+    overlap = overlap if overlap is not None else float(os.environ.get("TILE_OVERLAP", 0.2))
+    iou = iou if iou is not None else float(os.environ.get("TILE_IOU", 0.5))
+    if full is None:
+        full = os.environ.get("TILE_FULL", "1") not in ("0", "false", "False")
+
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    tiles = grid(*im.size, size, overlap)
+    if len(tiles) == 1:
+        return loaded.detect([im], conf=conf)[0]
+
+    with span("preprocess"):
+        images = [im.crop(tile) for tile in tiles]
+    origins = [tile[:2] for tile in tiles]
+    if full:
+        images.append(im)
+        origins.append((0, 0))
+    results = loaded.detect(images, conf=conf)
+
+    with span("postprocess"):
+        return _merge(results, origins, iou)
+
+def _merge(results:list, origins:list, iou:float) -> dict:
+    """
+    Shift the detection columns of each tile by its origin and merge them across tiles.
+    """
+    import numpy as np
+    from backends import nms
+    from detections import columns
+
+    names, boxes, classes, scores = {}, [], [], []
+    for result, (ox, oy) in zip(results, origins):
+        names.update(result["names"])
+        boxes.extend([x1 + ox, y1 + oy, x2 + ox, y2 + oy] for x1, y1, x2, y2 in result["boxes"])
+        classes.extend(result["classes"])
+        scores.extend(result["scores"])
+    boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+    classes = np.array(classes, dtype=np.int64)
+    scores = np.array(scores, dtype=np.float64)
+
+    keep = nms(boxes, scores, classes, iou, smaller=True)
+    return columns(boxes[keep], classes[keep], scores[keep], {int(c): name for c, name in names.items()})
@@ -0,0 +1,116 @@
+"""
+Upload size limits for the inference servers.
+
+Starlette parses a multipart body in full before a handler runs (files over 1 MB spill to
+temporary files), and `UploadFile.read()` then loads the whole file into memory, so an
+oversized upload used to cost its full size in RAM and disk. Two guards bound it:
+    BodyLimit    ASGI middleware counting the request body as it arrives. A request that
+                 declares (Content-Length) or sends more than its route's limit is answered
+                 413 straight away, before anything is parsed or spooled.
+    readUpload   reads an UploadFile in chunks and stops at the first chunk over the limit.
+The memory held by a request is then at most its limit plus one chunk, whatever the client sends.
+See `python bench.py oversized` for server RSS under concurrent oversized uploads.
+
+Settings (environment variables):
+    UPLOAD_MAX_BYTES(int, Default: 20 MiB): largest image (or zip archive) accepted in one upload field.
+    BATCH_MAX_BYTES(int, Default: 200 MiB): largest request body accepted by /predict/batch.
+    UPLOAD_CHUNK_BYTES(int, Default: 1 MiB): size of the chunks uploads are read in.
+"""
+import os
+
+MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 20 * 1024 * 1024))
+BATCH_MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", 200 * 1024 * 1024))
+CHUNK_BYTES = int(os.environ.get("UPLOAD_CHUNK_BYTES", 1024 * 1024))
+
+# Room for the multipart boundaries and headers around an upload field
+MULTIPART_OVERHEAD = 64 * 1024
+
+class UploadTooLarge(ValueError):
+    """
+    Raised by `readUpload` when an upload is larger than its limit.
+    """
+    def __init__(self, limit:int):
+        super().__init__(f"Upload is too large: at most {limit} bytes are accepted.")
+        self.limit = limit
+
+async def readUpload(upload, limit:int=None, chunk:int=None) -> bytes:
+    """
+    Read an UploadFile in chunks of `chunk` bytes; raises `UploadTooLarge` as soon as more than `limit` bytes are read.
+    """
+    limit = limit or MAX_BYTES
+    if upload.size is not None and upload.size > limit:
+        raise UploadTooLarge(limit)
+    data = bytearray()
+    while True:
+        block = await upload.read(chunk or CHUNK_BYTES)
+        if not block:
+            return bytes(data)
+        if len(data) + len(block) > limit:
+            raise UploadTooLarge(limit)
+        data += block
+
+class _BodyTooLarge(Exception):
+    pass
+
+class BodyLimit:
+    """
+    ASGI middleware rejecting request bodies larger than the limit of their route with 413.
+    limits: {path: most bytes}; other paths are not limited.
+    """
+    def __init__(self, app, limits:dict=None):
+        self.app = app
+        self.limits = limits if limits is not None else {
+            "/predict": MAX_BYTES + MULTIPART_OVERHEAD,
+            "/predict/batch": BATCH_MAX_BYTES,
+        }
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        length = headers.get(b"content-length", b"")
+        if length.isdigit() and int(length) > limit:
+            await self._reject(send, limit)
+            return
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def limitedReceive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise _BodyTooLarge()
+            return message
+
+        async def limitedSend(message):
+            nonlocal started
+            if exceeded:
+                # Whatever the app answers to the broken body (e.g. 400 from the form parser) is replaced by the 413
+                return
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, limitedReceive, limitedSend)
+        except _BodyTooLarge:
+            pass
+        if exceeded and not started:
+            await self._reject(send, limit)
+
+    @staticmethod
+    async def _reject(send, limit:int):
+        body = f'{{"error":"Upload is too large: at most {limit} bytes are accepted."}}'.encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), (b"connection", b"close")],
+        })
+        await send({"type": "http.response.body", "body": body})
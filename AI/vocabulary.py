@@ -0,0 +1,85 @@
+"""
+Open-vocabulary serving with YOLOE.
+
+A YOLOE model (weights named like `yoloe-11s-seg.pt`, see backends.YoloeBackend) detects
+whichever classes it is prompted with. The servers prompt it with the species the team
+collects images of, one per `*_url.txt` list in this folder (`lantana_url.txt` -> "lantana"),
+or with YOLOE_PROMPTS.
+
+Encoding the prompts runs the MobileCLIP text encoder, which costs far more than a forward
+pass, so it is done once per model and prompt set: the embeddings are cached on disk, keyed
+by a hash of the weights, the text encoder and the prompt list, and every later load, process
+worker and restart reads them back instead.
+
+Settings (environment variables):
+    YOLOE_PROMPTS(str, Default: the *_url.txt categories): comma separated class names to prompt with.
+    EMBEDDING_CACHE_DIR(str, Default: "embeddings"): folder of the cached text embeddings.
+"""
+import os
+import hashlib
+import threading
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+_hashes = {} # (real path, mtime) -> SHA-256 of the weights
+_lock = threading.Lock()
+
+def prompts(folder:str=FOLDER) -> list:
+    """
+    The class names to prompt with: os.environ["YOLOE_PROMPTS"], else one per `<name>_url.txt` in `folder`.
+    """
+    names = os.environ.get("YOLOE_PROMPTS")
+    if names:
+        return [name.strip() for name in names.split(",") if name.strip()]
+    return sorted(
+        name[:-len("_url.txt")].replace("_", " ")
+        for name in os.listdir(folder) if name.endswith("_url.txt")
+    )
+
+def fileHash(path:str) -> str:
+    """
+    SHA-256 of a weights file, computed once per (real path, mtime).
+    """
+    real = os.path.realpath(path)
+    key = (real, os.path.getmtime(real))
+    with _lock:
+        if key in _hashes:
+            return _hashes[key]
+    digest = hashlib.sha256()
+    with open(real, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    with _lock:
+        _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+def cacheKey(path:str, names:list, text_model:str) -> str:
+    """
+    Cache key of the embeddings of `names` for the weights `path` and text encoder `text_model`.
+    """
+    return hashlib.sha256("\n".join([fileHash(path), text_model, *names]).encode()).hexdigest()
+
+def textEmbeddings(model, path:str, names:list, folder:str=None):
+    """
+    Text prompt embeddings of `names` for `model`, an Ultralytics YOLOE loaded from `path`;
+    read from the cache in `folder` (Default: os.environ["EMBEDDING_CACHE_DIR"]), or encoded and added to it.
+    """
+    import torch
+
+    folder = folder or os.environ.get("EMBEDDING_CACHE_DIR", "embeddings")
+    text_model = getattr(model.model, "text_model", "mobileclip:blt")
+    file = os.path.join(folder, f"{cacheKey(path, names, text_model)}.pt")
+    if os.path.exists(file):
+        cached = torch.load(file, map_location="cpu")
+        if cached["names"] == names:
+            print(f" [ Loaded embeddings of {len(names)} prompts from {file} ]")
+            return cached["embeddings"]
+
+    print(f" [ Encoding {len(names)} prompts with {text_model} ... ]")
+    embeddings = model.get_text_pe(names)
+    os.makedirs(folder, exist_ok=True)
+    # Written under a temporary name, so that a worker loading at the same time never reads half a file
+    tmp = f"{file}.{os.getpid()}.tmp"
+    torch.save({"names": names, "text_model": text_model, "embeddings": embeddings.cpu()}, tmp)
+    os.replace(tmp, file)
+    return embeddings
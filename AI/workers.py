@@ -0,0 +1,290 @@
+"""
+Bounded worker pool that runs blocking inference off the event loop.
+
+The event loop only queues work and awaits it, so `/health` and other requests stay
+responsive while a batch is in the model. The pool has a fixed number of workers and
+a fixed-size waiting queue; work beyond it is rejected straight away with `Busy`
+instead of piling up latency.
+
+In process mode every worker is its own process that loads the model once at start
+and pins torch to `threads` threads, so that workers x threads matches the physical
+cores instead of every worker fighting for all of them. Jobs go to the least loaded worker.
+A worker process that dies (killed for memory, a crash in native code) is replaced, and the
+jobs it took down are retried on the other workers.
+
+Settings (environment variables):
+    INFERENCE_EXECUTOR(str, Default: thread): "thread" or "process".
+    INFERENCE_WORKERS(int, Default: 1): number of workers. With torch on CPU one worker already uses every core.
+    INFERENCE_THREADS(int, Default: physical cores / workers): torch threads per worker.
+    INFERENCE_QUEUE_SIZE(int, Default: 4): most jobs waiting for a free worker.
+"""
+import os
+import math
+import time
+import asyncio
+
+class Busy(Exception):
+    """
+    Raised when work is rejected because the queue is full.
+    retry_after: seconds after which a retry is likely to be admitted.
+    """
+    def __init__(self, message:str, retry_after:int=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _timed(fn, args:tuple, submitted:float):
+    """
+    Run `fn(*args)` in a worker and also return how long the job waited for it, how long it ran,
+    the stage spans it recorded (see metrics.py) and the registry keys of the models it ran on.
+    Wall-clock time is used because process workers do not share a monotonic clock with the parent.
+    """
+    from metrics import collect
+    from registry import served
+    started = time.time()
+    with collect() as stages, served() as models:
+        result = fn(*args)
+    return result, started - submitted, time.time() - started, stages, models
+
+def physicalCores() -> int:
+    try:
+        import psutil
+        cores = psutil.cpu_count(logical=False)
+    except ImportError:
+        cores = None
+    return cores or os.cpu_count() or 1
+
+def pinThreads(threads:int):
+    """
+    Limit torch (and the OpenMP/MKL pools under it) to `threads` threads in this process.
+    """
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+
+def _initProcess(model:str, threads:int):
+    """
+    Process worker initialiser: pin the torch threads, then load the default model before the first job arrives
+    and watch for new versions of it.
+    """
+    pinThreads(threads)
+    from registry import registry, resolveModel
+    model = resolveModel(model)
+    if model is not None:
+        registry.preload(model)
+    registry.watch()
+
+def _registryStats() -> dict:
+    """
+    Process worker job: the stats of the model registry of this worker.
+    """
+    from registry import registry
+    return registry.stats()
+
+class InferencePool:
+    """
+    A thread or process pool with admission control and queue metrics.
+    """
+    def __init__(self, kind:str=None, workers:int=None, threads:int=None, queue_size:int=None):
+        self.kind = kind or os.environ.get("INFERENCE_EXECUTOR", "thread")
+        self.workers = workers or int(os.environ.get("INFERENCE_WORKERS", 1))
+        self.threads = threads or int(os.environ.get("INFERENCE_THREADS", 0)) or None
+        self.queue_size = queue_size if queue_size is not None else int(os.environ.get("INFERENCE_QUEUE_SIZE", 4))
+        if self.kind not in ("thread", "process"):
+            raise ValueError(f"Unknown INFERENCE_EXECUTOR {self.kind!r}: use 'thread' or 'process'.")
+        self._executors = [] # one executor for threads; one single-process executor per worker for processes
+        self._load = [] # jobs running or waiting on each executor
+        self.inflight = 0 # admitted jobs, running or waiting
+        # Metrics
+        self.jobs = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+    @property
+    def waiting(self) -> int:
+        """
+        Admitted jobs that have no worker yet.
+        """
+        return max(0, self.inflight - self.workers)
+
+    def start(self):
+        """
+        Create the executor(s). Process workers pin their threads and preload os.environ["DEFAULT_MODEL"].
+        """
+        if self._executors:
+            return
+        if self.kind == "process":
+            self.threads = threads = self.threads or max(1, physicalCores() // self.workers)
+            self._executors = [self._process() for _ in range(self.workers)]
+            print(f" [ Inference pool: {self.workers} process worker(s) x {threads} thread(s), queue of {self.queue_size} ]")
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            if self.threads:
+                pinThreads(self.threads)
+            self._executors = [ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")]
+            print(f" [ Inference pool: {self.workers} thread worker(s), queue of {self.queue_size} ]")
+        self._load = [0] * len(self._executors)
+
+    def _process(self):
+        """
+        A new single-process executor for a process worker.
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn: forking a parent that has already initialised torch is not safe
+        executor = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_initProcess,
+            initargs=(os.environ.get("DEFAULT_MODEL"), self.threads),
+        )
+        # Processes are spawned on demand; start it now so it loads the model before traffic arrives
+        executor.submit(os.getpid)
+        return executor
+
+    def _replace(self, worker:int, broken):
+        """
+        Replace the executor of process worker `worker`, `broken` because its process died.
+        """
+        if self._executors[worker] is not broken:
+            return # already replaced by another job it took down
+        broken.shutdown(wait=False)
+        self._executors[worker] = self._process()
+        self.restarts += 1
+        print(f" [ Inference worker {worker} died; started a new one ]")
+
+    def shutdown(self):
+        for executor in self._executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._executors = []
+        self._load = []
+
+    def ready(self):
+        """
+        Block until every worker has started (and, for processes, loaded the default model).
+        """
+        self.start()
+        for executor in self._executors:
+            executor.submit(os.getpid).result()
+
+    def broadcast(self, fn, *args) -> list:
+        """
+        Run `fn(*args)` once on every worker process (once in all for threads) and block until all have returned.
+        For setup outside the request path, e.g. a warm-up batch; not counted in the job metrics.
+        """
+        self.start()
+        futures = [executor.submit(fn, *args) for executor in self._executors]
+        return [future.result() for future in futures]
+
+    def retryAfter(self) -> int:
+        """
+        Estimated seconds until the current backlog has been worked off.
+        """
+        mean_run = self.run_total / self.jobs if self.jobs else 1.0
+        return max(1, math.ceil(mean_run * (self.waiting + 1) / self.workers))
+
+    async def run(self, fn, *args, spans:list=None, models:list=None):
+        """
+        Run `fn(*args)` on a worker and return its result.
+        spans(list, Default=None): `metrics.Timings` of the requests served by this job; the time waited
+        for a worker and the stages recorded by `fn` are added to each of them.
+        models(list, Default=None): gets the registry keys of the models `fn` ran on (see registry.served).
+        Raises `Busy` immediately if the waiting queue is full.
+        If the worker process dies while the job is on it, the job is retried on each other worker in turn.
+        """
+        from concurrent.futures.process import BrokenProcessPool
+
+        if self.inflight >= self.workers + self.queue_size:
+            self.rejected += 1
+            raise Busy(f"{self.waiting} jobs are already waiting for a worker.", self.retryAfter())
+        self.start()
+
+        loop = asyncio.get_running_loop()
+        tried = set()
+        while True:
+            # Least loaded worker first; ties go to the lowest index so idle workers stay warm
+            worker = min((i for i in range(len(self._executors)) if i not in tried), key=self._load.__getitem__)
+            executor = self._executors[worker]
+            self.inflight += 1
+            self._load[worker] += 1
+            try:
+                result, waited, took, stages, served = await loop.run_in_executor(executor, _timed, fn, args, time.time())
+                break
+            except BrokenProcessPool:
+                self._replace(worker, executor)
+                tried.add(worker)
+                if len(tried) == len(self._executors):
+                    raise
+            finally:
+                self.inflight -= 1
+                self._load[worker] -= 1
+        self.jobs += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.run_total += took
+        for timings in spans or ():
+            timings.record("queue", waited)
+            timings.merge(stages)
+        if models is not None:
+            models.extend(served)
+        return result
+
+    def modelStats(self, timeout:float=2.0) -> dict:
+        """
+        `registry.stats()` of the models the jobs run on. Threads share the registry of this process; every process
+        worker has its own, so theirs are merged: each model is listed once per worker holding it, with that "worker",
+        "bytes" and "swaps" are summed and "budget_bytes" is the budget of one worker.
+        Blocks until the workers answer, after their current job: call it off the event loop. Workers that have not
+        answered within `timeout` seconds are listed in "unavailable".
+        """
+        from concurrent.futures import TimeoutError
+        from concurrent.futures.process import BrokenProcessPool
+        from registry import registry
+
+        if self.kind != "process":
+            return registry.stats()
+        merged = {"models": [], "bytes": 0, "budget_bytes": registry.memory_budget, "aliases": {}, "swapping": [], "swaps": 0, "unavailable": []}
+        futures = []
+        for worker, executor in enumerate(list(self._executors)):
+            try:
+                futures.append((worker, executor.submit(_registryStats)))
+            except BrokenProcessPool:
+                merged["unavailable"].append(worker)
+        end = time.time() + timeout
+        for worker, future in futures:
+            try:
+                stats = future.result(timeout=max(0, end - time.time()))
+            except (TimeoutError, BrokenProcessPool):
+                merged["unavailable"].append(worker)
+                continue
+            merged["models"].extend({**m, "worker": worker} for m in stats["models"])
+            merged["bytes"] += stats["bytes"]
+            merged["budget_bytes"] = stats["budget_bytes"]
+            merged["aliases"].update(stats["aliases"])
+            merged["swapping"].extend(path for path in stats["swapping"] if path not in merged["swapping"])
+            merged["swaps"] += stats["swaps"]
+        merged["unavailable"].sort()
+        return merged
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "threads_per_worker": self.threads,
+            "worker_load": list(self._load),
+            "max_queue": self.queue_size,
+            "running": min(self.inflight, self.workers),
+            "queue_depth": self.waiting,
+            "jobs": self.jobs,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+            "mean_wait_ms": round(self.wait_total / self.jobs * 1000, 2) if self.jobs else 0.0,
+            "max_wait_ms": round(self.wait_max * 1000, 2),
+            "mean_run_ms": round(self.run_total / self.jobs * 1000, 2) if self.jobs else 0.0,
+        }
+
+# The pool shared by everything in this process
+pool = InferencePool()
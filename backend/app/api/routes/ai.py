@@ -9,12 +9,15 @@ Key Features:
 - Image validation and size limits
 - Content type checking
 - Automatic endpoint fallback (/detect vs /predict)
+- Request deadlines, so the GPU server drops work the proxy has given up on
+- Multi-image batch prediction with streamed NDJSON results
 - Serverless deployment compatibility
 """
 
-from fastapi import APIRouter, UploadFile, Response, Query
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, UploadFile, Response, Query, Header
+from fastapi.responses import JSONResponse, StreamingResponse
 import os
+import time
 import httpx
 from app.core.config import settings
 
@@ -30,6 +33,10 @@ GPU_SERVER = os.getenv(
     "http://ec2-54-252-175-180.ap-southeast-2.compute.amazonaws.com/detect",
 )
 
+# How long a prediction is waited for; the GPU server is told when it runs out
+# (X-Request-Deadline, Unix time in seconds) so that it drops the request instead of running it for nobody
+PREDICT_TIMEOUT = 60.0
+
 
 @router.get("/ping")
 async def ping():
@@ -42,7 +49,11 @@ async def ping():
     return {"status": "ok"}
 
 @router.post("/predict")
-async def proxy_predict(img: UploadFile, model: str | None = Query(default=None)):
+async def proxy_predict(
+    img: UploadFile,
+    model: str | None = Query(default=None),
+    accept: str | None = Header(default=None),
+):
     """
     Proxy plant identification requests to the GPU inference server.
     
@@ -52,6 +63,8 @@ async def proxy_predict(img: UploadFile, model: str | None = Query(default=None)
     Args:
         img (UploadFile): The uploaded image file for plant identification
         model (str, optional): Specific model to use for prediction
+        accept (str, optional): Accept header, forwarded so that clients can ask
+            for the GPU server's compact columnar or msgpack format
         
     Returns:
         Response: The GPU server's prediction response or error
@@ -60,6 +73,7 @@ async def proxy_predict(img: UploadFile, model: str | None = Query(default=None)
         415: Unsupported media type
         413: File too large
         502: GPU server unavailable
+        504: GPU server could not run the image before the deadline
     """
     
     # === IMAGE VALIDATION ===
@@ -120,10 +134,15 @@ async def proxy_predict(img: UploadFile, model: str | None = Query(default=None)
     if model:
         data["model"] = model
     
+    # Absolute deadline shared by every endpoint tried: past it, the GPU server's answer is no longer awaited
+    headers = {"X-Request-Deadline": f"{time.time() + PREDICT_TIMEOUT:.3f}"}
+    if accept:
+        headers["Accept"] = accept
+
     # === SMART ENDPOINT FALLBACK ===
     # Try the configured URL first; on 404, retry alternate path (/detect <-> /predict)
     # This handles cases where the GPU server endpoint might be different
-    async with httpx.AsyncClient(timeout=60.0) as client:
+    async with httpx.AsyncClient(timeout=PREDICT_TIMEOUT) as client:
         try_urls = [GPU_SERVER]
         
         # Add smart fallback if path looks like /detect or /predict or has no path
@@ -153,7 +172,7 @@ async def proxy_predict(img: UploadFile, model: str | None = Query(default=None)
         last_response: httpx.Response | None = None
         for url in try_urls:
             try:
-                r = await client.post(url, files=files, data=data)
+                r = await client.post(url, files=files, data=data, headers=headers)
                 last_response = r
                 # If we get a successful response (not 404), use it
                 if r.status_code != 404:
@@ -173,3 +192,120 @@ async def proxy_predict(img: UploadFile, model: str | None = Query(default=None)
     )
 
 
+def _batch_url() -> str:
+    """
+    Build the GPU server's batch endpoint from GPU_SERVER.
+    
+    GPU_SERVER points at the single-image endpoint (/detect or /predict);
+    the batch endpoint lives at /predict/batch on the same host.
+    """
+    from urllib.parse import urlparse, urlunparse
+    parsed = urlparse(GPU_SERVER)
+    path = parsed.path or ''
+    for suffix in ('/detect', '/predict'):
+        if path.endswith(suffix):
+            path = path[:-len(suffix)]
+            break
+    return urlunparse(parsed._replace(path=path.rstrip('/') + '/predict/batch'))
+
+
+@router.post("/predict/batch")
+async def proxy_predict_batch(imgs: list[UploadFile], model: str | None = Query(default=None)):
+    """
+    Proxy multi-image identification requests to the GPU inference server.
+    
+    Accepts many images at once, as repeated `imgs` fields and/or zip archives
+    of images, and streams the GPU server's NDJSON response straight through,
+    so the client can render each result as soon as it is ready.
+
+    Each image may be up to MAX_FILE_SIZE, and the whole request up to
+    MAX_BATCH_SIZE (zip archives count towards that total only).
+
+    No X-Request-Deadline is sent: a batch streams for as long as it takes.
+    Work is dropped only when the client disconnects, which closes the
+    upstream stream, and the GPU server then cancels the queued images.
+    
+    Args:
+        imgs (list[UploadFile]): The images (or zip archives of images) to identify
+        model (str, optional): Specific model to use for prediction
+        
+    Returns:
+        StreamingResponse: One JSON line per image, in completion order
+        
+    Raises:
+        415: Unsupported media type
+        413: An image or the whole upload too large
+        502: GPU server unavailable
+    """
+    
+    # === UPLOAD VALIDATION ===
+    # Images must be allowed image types; zip archives are unpacked by the GPU server
+    allowed_types = set(settings.ALLOWED_IMAGE_TYPES) | {"application/zip", "application/x-zip-compressed"}
+    for img in imgs:
+        if img.content_type not in allowed_types:
+            return JSONResponse(
+                status_code=415,
+                content={
+                    "detail": f"Unsupported media type: {img.content_type} ({img.filename}). Allowed: {sorted(list(allowed_types))}"
+                },
+            )
+
+    # === SIZE VALIDATION ===
+    # Each image must fit the single image limit; the whole request must fit the batch limit
+    size_bytes = 0
+    for img in imgs:
+        img.file.seek(0, os.SEEK_END)
+        file_bytes = img.file.tell()
+        img.file.seek(0)
+        if img.content_type in settings.ALLOWED_IMAGE_TYPES and file_bytes > settings.MAX_FILE_SIZE:
+            return JSONResponse(
+                status_code=413,
+                content={
+                    "detail": f"File too large: {img.filename}",
+                    "max_bytes": settings.MAX_FILE_SIZE,
+                    "received_bytes": file_bytes,
+                },
+            )
+        size_bytes += file_bytes
+    if size_bytes > settings.MAX_BATCH_SIZE:
+        return JSONResponse(
+            status_code=413,
+            content={
+                "detail": "Upload too large",
+                "max_bytes": settings.MAX_BATCH_SIZE,
+                "received_bytes": size_bytes,
+            },
+        )
+
+    # === PREPARE REQUEST DATA ===
+    files = [
+        ("imgs", (img.filename, img.file, img.content_type or "application/octet-stream"))
+        for img in imgs
+    ]
+    params = {"model": model} if model else {}
+
+    # === STREAM FROM GPU SERVER ===
+    # The client must stay open until the whole response has been relayed,
+    # so it is closed by the streaming generator rather than a context manager
+    client = httpx.AsyncClient(timeout=httpx.Timeout(60.0, read=300.0))
+    try:
+        request = client.build_request("POST", _batch_url(), files=files, params=params)
+        upstream = await client.send(request, stream=True)
+    except Exception as e:
+        await client.aclose()
+        print(f"Error connecting to {_batch_url()}: {e}")
+        return JSONResponse(status_code=502, content={"detail": "GPU server unavailable"})
+
+    async def relay():
+        try:
+            async for chunk in upstream.aiter_raw():
+                yield chunk
+        finally:
+            await upstream.aclose()
+            await client.aclose()
+
+    return StreamingResponse(
+        relay(),
+        status_code=upstream.status_code,
+        media_type=upstream.headers.get("content-type", "application/x-ndjson"),
+    )
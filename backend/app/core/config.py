@@ -28,6 +28,7 @@ class Settings(BaseSettings):
     # File upload settings
     UPLOAD_DIR: str = "uploads"
     MAX_FILE_SIZE: int = 10 * 1024 * 1024  # 10MB
+    MAX_BATCH_SIZE: int = 200 * 1024 * 1024  # 200MB, all files of a batch request; matches the GPU server's BATCH_MAX_BYTES
     ALLOWED_IMAGE_TYPES: List[str] = ["image/jpeg", "image/png", "image/webp"]
     
     # Geospatial settings